@@ -0,0 +1,72 @@
+"""Compare two sets of results saved by bench/load.py (or bench/micro.py).
+
+    python bench/compare.py OLD NEW
+
+where OLD and NEW are result files, or git shas (or unique prefixes of them)
+with results in bench/results. Micro-benchmark results are named by sha with
+a micro- prefix, e.g. micro-1a2b3c.
+"""
+
+import glob
+import json
+import os
+import sys
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+# for each field, whether a bigger number is better
+FIELDS = (
+    ('throughput', True),
+    ('ops_per_sec', True),
+    ('p50_ms', False),
+    ('p99_ms', False),
+    ('queries_per_request', False),
+    ('allocations', False),
+    )
+
+def find_results(name):
+    if os.path.exists(name):
+        return name
+    matches = glob.glob(os.path.join(RESULTS_DIR, name + '*.json'))
+    if len(matches) != 1:
+        raise SystemExit('%d result files match %r' % (len(matches), name))
+    return matches[0]
+
+def load(name):
+    with open(find_results(name)) as f:
+        results = json.load(f)
+    return results, dict((scenario, r) for scenario, r in results['scenarios'])
+
+def change(old, new, bigger_is_better):
+    if not old or new is None:
+        return ''
+    pct = 100.0 * (new - old) / old
+    better = pct > 0 if bigger_is_better else pct < 0
+    marker = '' if abs(pct) < 5 else (' +' if better else ' !')
+    return '%+.1f%%%s' % (pct, marker)
+
+def main():
+    if len(sys.argv) != 3:
+        raise SystemExit(__doc__.strip())
+    old_results, old = load(sys.argv[1])
+    new_results, new = load(sys.argv[2])
+    print 'old: %s%s' % (old_results['sha'][:12], ' (dirty)' if old_results['dirty'] else '')
+    print 'new: %s%s' % (new_results['sha'][:12], ' (dirty)' if new_results['dirty'] else '')
+    print
+    print '%-24s %-20s %12s %12s %12s' % ('scenario', 'field', 'old', 'new', 'change')
+    for scenario, _ in new_results['scenarios']:
+        if scenario not in old:
+            continue
+        for field, bigger_is_better in FIELDS:
+            if field not in new[scenario]:
+                continue
+            old_value = old[scenario].get(field)
+            new_value = new[scenario][field]
+            print '%-24s %-20s %12s %12s %12s' % (
+                scenario, field,
+                '%.2f' % old_value if old_value is not None else '-',
+                '%.2f' % new_value if new_value is not None else '-',
+                change(old_value, new_value, bigger_is_better))
+
+if __name__ == '__main__':
+    main()
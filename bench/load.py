@@ -0,0 +1,235 @@
+"""Load tests for the main endpoints.
+
+This starts bench/server.py (graff in --memory mode with a synthetic corpus),
+and then runs each scenario against it for a fixed time with a number of
+concurrent keep-alive connections. The throughput, latency percentiles and
+number of SQL queries per request (from /_status/metrics) are reported for
+each scenario, and saved to bench/results/<git sha>.json for comparing with
+bench/compare.py.
+"""
+
+import datetime
+import httplib
+import json
+import optparse
+import os
+import random
+import re
+import struct
+import subprocess
+import sys
+import threading
+import time
+import urllib
+import zlib
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_DIR = os.path.join(BENCH_DIR, 'results')
+
+def make_png(rng, width=64, height=64):
+    """Make a small random PNG, without needing PIL on the client."""
+    def chunk(kind, data):
+        return struct.pack('!I', len(data)) + kind + data + struct.pack('!I', zlib.crc32(kind + data) & 0xffffffff)
+    rows = ''.join('\x00' + ''.join(chr(rng.randint(0, 255)) for _ in xrange(width * 3)) for _ in xrange(height))
+    return ('\x89PNG\r\n\x1a\n' +
+            chunk('IHDR', struct.pack('!IIBBBBB', width, height, 8, 2, 0, 0, 0)) +
+            chunk('IDAT', zlib.compress(rows)) +
+            chunk('IEND', ''))
+
+def random_box(rng, bounds, fraction=0.2):
+    """Get a random box inside bounds, with sides fraction of the size."""
+    height = (bounds['n'] - bounds['s']) * fraction
+    width = (bounds['e'] - bounds['w']) * fraction
+    s = rng.uniform(bounds['s'], bounds['n'] - height)
+    w = rng.uniform(bounds['w'], bounds['e'] - width)
+    return {'n': s + height, 's': s, 'e': w + width, 'w': w}
+
+def scenarios(corpus, images):
+    """Get the scenarios, as a list of (name, make_request) pairs where
+    make_request(rng) returns a (method, path, body, headers) tuple.
+    """
+    photos = corpus['photos']
+    bounds = corpus['bounds']
+
+    def photos_unbounded(rng):
+        return 'GET', '/photos?count=20', None, {}
+
+    def photos_bounded(rng):
+        box = random_box(rng, bounds)
+        box['count'] = 20
+        return 'GET', '/photos?' + urllib.urlencode(box), None, {}
+
+    def thumbnail(rng):
+        return 'GET', '/p/%s.t' % (rng.choice(photos),), None, {}
+
+    def photo_page(rng):
+        return 'GET', '/photo/%s' % (rng.choice(photos),), None, {}
+
+    def home(rng):
+        return 'GET', '/', None, {}
+
+    def upload(rng):
+        # trailing garbage makes each upload unique, so none are deduplicated
+        boundary = '----graffbench%016x' % (rng.getrandbits(64),)
+        body = '\r\n'.join([
+            '--' + boundary,
+            'Content-Disposition: form-data; name="img"; filename="bench.png"',
+            'Content-Type: image/png',
+            '',
+            rng.choice(images) + os.urandom(16),
+            '--' + boundary + '--',
+            ''])
+        return 'POST', '/upload', body, {'Content-Type': 'multipart/form-data; boundary=' + boundary}
+
+    return [
+        ('photos_unbounded', photos_unbounded),
+        ('photos_bounded', photos_bounded),
+        ('thumbnail', thumbnail),
+        ('photo_page', photo_page),
+        ('home', home),
+        ('upload', upload),
+        ]
+
+def metric_total(text, name):
+    """Add up all of the series of a metric in the Prometheus text format."""
+    total = 0.0
+    for m in re.finditer(r'^%s(?:\{[^}]*\})? (\S+)$' % (re.escape(name),), text, re.M):
+        total += float(m.group(1))
+    return total
+
+def query_count(port):
+    conn = httplib.HTTPConnection('127.0.0.1', port)
+    conn.request('GET', '/_status/metrics')
+    text = conn.getresponse().read()
+    conn.close()
+    return metric_total(text, 'graff_db_query_seconds_count')
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    return sorted_values[int(round(p * (len(sorted_values) - 1)))]
+
+def run_scenario(port, make_request, duration, concurrency, warmup, seed):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def worker(n, deadline, record):
+        rng = random.Random(seed * 1000 + n)
+        conn = httplib.HTTPConnection('127.0.0.1', port)
+        while time.time() < deadline:
+            method, path, body, headers = make_request(rng)
+            start = time.time()
+            try:
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+                response.read()
+                ok = response.status < 400
+            except (httplib.HTTPException, IOError):
+                conn.close()
+                conn = httplib.HTTPConnection('127.0.0.1', port)
+                ok = False
+            elapsed = time.time() - start
+            if record:
+                with lock:
+                    latencies.append(elapsed)
+                    if not ok:
+                        errors[0] += 1
+        conn.close()
+
+    def run(seconds, record):
+        deadline = time.time() + seconds
+        threads = [threading.Thread(target=worker, args=(n, deadline, record)) for n in xrange(concurrency)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    run(warmup, False)
+    queries_before = query_count(port)
+    start = time.time()
+    run(duration, True)
+    elapsed = time.time() - start
+    queries = query_count(port) - queries_before
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'throughput': len(latencies) / elapsed,
+        'mean_ms': 1000 * sum(latencies) / len(latencies) if latencies else None,
+        'p50_ms': 1000 * percentile(latencies, 0.50) if latencies else None,
+        'p99_ms': 1000 * percentile(latencies, 0.99) if latencies else None,
+        'queries_per_request': queries / len(latencies) if latencies else None,
+        }
+
+def git_revision():
+    def git(*args):
+        return subprocess.Popen(('git',) + args, stdout=subprocess.PIPE, cwd=BENCH_DIR).communicate()[0].strip()
+    sha = git('rev-parse', 'HEAD') or 'unknown'
+    dirty = bool(git('status', '--porcelain', '--untracked-files=no'))
+    return sha, dirty
+
+def start_server(opts):
+    args = [sys.executable, os.path.join(BENCH_DIR, 'server.py'),
+            '--port', str(opts.port), '--users', str(opts.users),
+            '--photos', str(opts.photos), '--seed', str(opts.seed)]
+    server = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    line = server.stdout.readline()
+    if not line:
+        raise SystemExit('bench server failed to start')
+    return server, json.loads(line)
+
+def print_results(results):
+    print '%-18s %10s %8s %10s %10s %10s %8s' % ('scenario', 'req/s', 'errors', 'p50 ms', 'p99 ms', 'mean ms', 'q/req')
+    for name, r in results['scenarios']:
+        print '%-18s %10.1f %8d %10.2f %10.2f %10.2f %8.2f' % (
+            name, r['throughput'], r['errors'], r['p50_ms'] or 0, r['p99_ms'] or 0,
+            r['mean_ms'] or 0, r['queries_per_request'] or 0)
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-p', '--port', type='int', default=9100)
+    parser.add_option('-d', '--duration', type='float', default=10.0, help='seconds to run each scenario for')
+    parser.add_option('-w', '--warmup', type='float', default=2.0, help='seconds of warmup before each scenario')
+    parser.add_option('-c', '--concurrency', type='int', default=8)
+    parser.add_option('--users', type='int', default=200)
+    parser.add_option('--photos', type='int', default=20000)
+    parser.add_option('--seed', type='int', default=0)
+    parser.add_option('-s', '--scenario', action='append', help='only run these scenarios')
+    parser.add_option('-o', '--output', help='where to save the results (default: bench/results/<sha>.json)')
+    opts, args = parser.parse_args()
+
+    sha, dirty = git_revision()
+    rng = random.Random(opts.seed)
+    images = [make_png(rng) for _ in xrange(16)]
+
+    server, corpus = start_server(opts)
+    try:
+        results = {
+            'sha': sha,
+            'dirty': dirty,
+            'date': datetime.datetime.now().isoformat(),
+            'python': sys.version.split()[0],
+            'options': {'duration': opts.duration, 'concurrency': opts.concurrency,
+                        'users': opts.users, 'photos': opts.photos, 'seed': opts.seed},
+            'scenarios': [],
+            }
+        for name, make_request in scenarios(corpus, images):
+            if opts.scenario and name not in opts.scenario:
+                continue
+            sys.stderr.write('running %s...\n' % (name,))
+            results['scenarios'].append(
+                (name, run_scenario(opts.port, make_request, opts.duration, opts.concurrency, opts.warmup, opts.seed)))
+    finally:
+        server.terminate()
+        server.wait()
+
+    print_results(results)
+    output = opts.output or os.path.join(RESULTS_DIR, '%s%s.json' % (sha, '-dirty' if dirty else ''))
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    sys.stderr.write('saved results to %s\n' % (output,))
+
+if __name__ == '__main__':
+    main()
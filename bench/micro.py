@@ -0,0 +1,202 @@
+"""Micro-benchmarks for the functions on the hot paths: id and cookie
+encryption, the geo helpers, photo serialization and variant rendering.
+
+Each benchmark is run repeatedly for at least --min-time seconds, and the best
+of --repeat runs is reported in operations per second. Allocations per
+operation are measured with tracemalloc if it's available (memory blocks
+allocated), and otherwise as the net number of gc-tracked objects created.
+
+Results are saved to bench/results/micro-<git sha>.json, which can be compared
+with bench/compare.py like the load test results.
+"""
+
+import datetime
+import gc
+import json
+import optparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from graff import config
+config.load_config(None, memory=True)
+
+import PIL.Image
+
+from graff import crypto
+from graff import db
+from graff import geo
+from graff import render
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from load import RESULTS_DIR, git_revision
+
+# the fixture images, as (name, format, size)
+FIXTURES = (
+    ('camera.jpg', 'JPEG', (3264, 2448)),
+    ('portrait.jpg', 'JPEG', (1200, 1600)),
+    ('small.jpg', 'JPEG', (640, 480)),
+    ('screenshot.png', 'PNG', (1280, 800)),
+    ('small.png', 'PNG', (320, 240)),
+    )
+
+def make_fixtures(dirname, seed):
+    """Write the fixture images to dirname. They're a coarse noise pattern
+    scaled up, which is closer to a photo than a flat color would be.
+    """
+    rng = random.Random(seed)
+    paths = []
+    for name, fmt, (width, height) in FIXTURES:
+        img = PIL.Image.new('RGB', (width / 16, height / 16))
+        img.putdata([(rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255))
+                     for _ in xrange((width / 16) * (height / 16))])
+        img = img.resize((width, height), PIL.Image.BICUBIC)
+        path = os.path.join(dirname, name)
+        img.save(path, fmt)
+        paths.append((name, fmt, path))
+    return paths
+
+def render_all(path, fmt, fsid):
+    """Render the original and every variant of an image, the way that they
+    are rendered for an upload with all of its variants rendered eagerly.
+    """
+    render.save_versions(render.load_image(path, ('o',)), fmt, fsid, ('o',))
+    for extension, _, _, _ in render.VARIANTS:
+        render.render_variant(fsid, extension, fmt)
+
+def count_allocations(func, number):
+    """Get the allocations per call of func, averaged over number calls."""
+    if tracemalloc is not None:
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        for _ in xrange(number):
+            func()
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        allocated = sum(max(stat.count_diff, 0) for stat in after.compare_to(before, 'lineno'))
+    else:
+        gc.collect()
+        gc.disable()
+        try:
+            before = len(gc.get_objects())
+            results = [func() for _ in xrange(number)]
+            allocated = len(gc.get_objects()) - before - 1
+            del results
+        finally:
+            gc.enable()
+    return float(allocated) / number
+
+def measure(func, min_time, repeat):
+    """Get the best ops/sec of func over repeat runs of at least min_time."""
+    # find a number of calls that takes at least min_time
+    number = 1
+    while True:
+        start = time.time()
+        for _ in xrange(number):
+            func()
+        elapsed = time.time() - start
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed < min_time / 10 else int(min_time / elapsed) + 1
+
+    best = elapsed
+    for _ in xrange(repeat - 1):
+        start = time.time()
+        for _ in xrange(number):
+            func()
+        best = min(best, time.time() - start)
+    return number / best, number
+
+def benchmarks(fixture_paths):
+    """Generate (name, func) pairs for each of the benchmarks."""
+    key = os.urandom(16)
+    cookie = os.urandom(10) + '\x00\x00\x00\x00'
+    ciphertext = crypto.encrypt_string(cookie, key=key)
+    # encid() and decid() are memoized, so the hit cases cycle through fewer
+    # ids than the caches hold, and the miss cases use ids (or tokens) that
+    # aren't cached
+    ids = range(1, min(1000, crypto._encid_cache.max_size) + 1)
+    tokens = crypto.encid_many(ids, key)
+    counter = iter(xrange(10 ** 9)).next
+
+    def decid_miss():
+        token = tokens[counter() % len(tokens)]
+        crypto._decid_cache.pop((key, token))
+        return crypto.decid(token, key)
+
+    yield 'encid', lambda: crypto.encid(ids[counter() % len(ids)], key)
+    yield 'encid_miss', lambda: crypto.encid(10 ** 6 + counter(), key)
+    yield 'encid_core', lambda: crypto.encid_core(ids[counter() % len(ids)], False, key)
+    yield 'encid_many_100', lambda: crypto.encid_many(ids[:100], key)
+    yield 'decid', lambda: crypto.decid(tokens[counter() % len(tokens)], key)
+    yield 'decid_miss', decid_miss
+    yield 'decid_core', lambda: crypto.decid_core(tokens[counter() % len(tokens)], False, key)
+    yield 'encrypt_string', lambda: crypto.encrypt_string(cookie, key=key)
+    yield 'decrypt_string', lambda: crypto.decrypt_string(ciphertext, key)
+
+    yield 'cover_bbox', lambda: geo.cover_bbox(37.81, -122.52, 37.70, -122.35, 12)
+    yield 'haversine_dist', lambda: geo.haversine_dist(37.77, -122.42, 40.71, -74.01)
+
+    now = datetime.datetime.now()
+    photo = db.Photo(id=12345, latitude=37.77, longitude=-122.42, time_created=now, user_id=1,
+                     user=db.User(id=1, name='bench'))
+    photos = [db.Photo(id=i, latitude=37.77, longitude=-122.42, time_created=now) for i in xrange(1, 61)]
+    yield 'Photo.to_json', photo.to_json
+    yield 'photos_json_60', lambda: db.photos_json(photos)
+
+    # the variants are written to the configured storage, under TEMPDIR
+    for name, fmt, path in fixture_paths:
+        fsid = os.urandom(16).encode('hex')
+        yield 'load_image:' + name, lambda path=path: render.load_image(path).load()
+        yield 'render_all:' + name, lambda path=path, fmt=fmt, fsid=fsid: render_all(path, fmt, fsid)
+        yield 'save_variant_t:' + name, lambda path=path, fmt=fmt, fsid=fsid: \
+            render.save_versions(render.load_image(path, ('t',)), fmt, fsid, ('t',))
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-t', '--min-time', type='float', default=0.5)
+    parser.add_option('-r', '--repeat', type='int', default=3)
+    parser.add_option('--seed', type='int', default=0)
+    parser.add_option('-o', '--output', help='where to save the results (default: bench/results/micro-<sha>.json)')
+    opts, args = parser.parse_args()
+
+    sha, dirty = git_revision()
+    tmpdir = tempfile.mkdtemp(prefix='graff-micro-')
+    os.environ['TEMPDIR'] = tmpdir
+    try:
+        fixture_paths = make_fixtures(tmpdir, opts.seed)
+        results = {
+            'sha': sha,
+            'dirty': dirty,
+            'date': datetime.datetime.now().isoformat(),
+            'python': sys.version.split()[0],
+            'allocations': 'tracemalloc blocks' if tracemalloc is not None else 'net gc objects',
+            'scenarios': [],
+            }
+        print '%-32s %14s %10s %12s' % ('benchmark', 'ops/sec', 'us/op', 'allocations')
+        for name, func in benchmarks(fixture_paths):
+            if args and not any(name.startswith(arg) for arg in args):
+                continue
+            ops_per_sec, number = measure(func, opts.min_time, opts.repeat)
+            allocations = count_allocations(func, min(number, 1000))
+            results['scenarios'].append((name, {'ops_per_sec': ops_per_sec, 'allocations': allocations}))
+            print '%-32s %14.1f %10.2f %12.1f' % (name, ops_per_sec, 1e6 / ops_per_sec, allocations)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    output = opts.output or os.path.join(RESULTS_DIR, 'micro-%s%s.json' % (sha, '-dirty' if dirty else ''))
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    sys.stderr.write('saved results to %s\n' % (output,))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""Boot graff.main:app in --memory mode with a synthetic corpus, for the load
+tests in bench/load.py.
+
+Once the server is listening, a single line of JSON describing the corpus (the
+port, and some photo ids, user names and bounds to request) is written to
+stdout.
+"""
+
+import datetime
+import json
+import optparse
+import os
+import random
+import sys
+import tempfile
+
+# These have to be set up before graff.main is imported. When stdin is a
+# terminal graff.main parses the command line itself, so it's detached here.
+os.environ['GRAFF_MEMORY'] = '1'
+sys.stdin = open(os.devnull)
+os.environ.setdefault('TEMPDIR', tempfile.mkdtemp(prefix='graff-bench-'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import geohash
+import PIL.Image
+import tornado.httpserver
+import tornado.ioloop
+
+# graff.main loads the config, which the other modules read when they're
+# imported (e.g. for their crypto keys), so it has to be imported first
+from graff.main import app
+from graff import config
+from graff import credentials
+from graff import crypto
+from graff import db
+from graff import render
+
+# the photos are spread over this box (roughly the SF bay area)
+BOUNDS = {'n': 38.0, 's': 37.2, 'w': -122.6, 'e': -121.8}
+
+def make_image(rng, width=1600, height=1200):
+    """Make a noisy gradient, which compresses about as badly as a photo."""
+    img = PIL.Image.new('RGB', (width / 8, height / 8))
+    img.putdata([(rng.randint(0, 255), (x * 7) % 256, (x * 13) % 256)
+                 for x in xrange((width / 8) * (height / 8))])
+    return img.resize((width, height), PIL.Image.BILINEAR)
+
+def seed(num_users, num_photos, num_images, rng):
+    session = db.Session()
+    pw_hash = credentials.hash_password('password')
+    users = []
+    for i in xrange(num_users):
+        users.append(db.User.create(session, name='user%d' % (i,), pw_hash=pw_hash,
+                                    email=None, location=None, remote_ip=0))
+    session.flush()
+
+    # Photos share a small set of stored images, as if they were re-uploads of
+    # the same files, so that seeding doesn't have to render every photo.
+    images = []
+    for _ in xrange(num_images):
+        fsid = os.urandom(16).encode('hex')
+        img = make_image(rng)
+        render.save_versions(img, 'JPEG', fsid, ('o',))
+        for extension in render.VARIANT_EXTS:
+            render.render_variant(fsid, extension, 'JPEG')
+        images.append((fsid, '%040x' % (rng.getrandbits(160),), img.size))
+
+    now = datetime.datetime.now()
+    for i in xrange(num_photos):
+        fsid, body_hash, (width, height) = rng.choice(images)
+        lat = rng.uniform(BOUNDS['s'], BOUNDS['n'])
+        lng = rng.uniform(BOUNDS['w'], BOUNDS['e'])
+        user = rng.choice(users + [None])
+        db.Photo.create(session,
+                        body_hash=body_hash,
+                        content_type='image/jpeg',
+                        fsid=fsid,
+                        latitude=lat,
+                        longitude=lng,
+                        geohash=geohash.encode(lat, lng, precision=db.GEOHASH_PRECISION),
+                        photo_time=now - datetime.timedelta(seconds=rng.randint(0, 86400 * 365)),
+                        photo_width=width,
+                        photo_height=height,
+                        remote_ip=0,
+                        sensor=True,
+                        time_created=now - datetime.timedelta(seconds=rng.randint(0, 86400 * 365)),
+                        user_id=user.id if user else None)
+    session.commit()
+
+    photo_ids = [row.id for row in session.query(db.Photo.id)]
+    rng.shuffle(photo_ids)
+    corpus = {
+        'photos': crypto.encid_many(photo_ids[:1000], db.Photo.secret_key),
+        'users': [u.name for u in users],
+        'bounds': BOUNDS,
+        }
+    session.close()
+    return corpus
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-p', '--port', type='int', default=9100)
+    parser.add_option('--users', type='int', default=200)
+    parser.add_option('--photos', type='int', default=20000)
+    parser.add_option('--images', type='int', default=8)
+    parser.add_option('--seed', type='int', default=0)
+    opts, args = parser.parse_args()
+
+    # the defaults are tuned for production, which would make seeding slow
+    config.setdefault('password_iterations', 1000)
+
+    corpus = seed(opts.users, opts.photos, opts.images, random.Random(opts.seed))
+    corpus['port'] = opts.port
+
+    server = tornado.httpserver.HTTPServer(app)
+    server.listen(opts.port, '127.0.0.1')
+    sys.stdout.write(json.dumps(corpus) + '\n')
+    sys.stdout.flush()
+    tornado.ioloop.IOLoop.instance().start()
+
+if __name__ == '__main__':
+    main()
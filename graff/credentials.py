@@ -0,0 +1,132 @@
+"""Password hashing.
+
+Hashes are stored as '<scheme>$<parameters>$<salt>$<hash>', so that the scheme
+and its work factor can be changed without invalidating existing passwords.
+Passwords stored with an old scheme (or a lower work factor than is currently
+configured) are rehashed the next time that their owner logs in.
+
+Hashing is deliberately slow, so it should be done in the executor (see run())
+rather than on the IOLoop.
+"""
+
+import binascii
+import hashlib
+import hmac
+import os
+
+from graff import config
+from graff.executor import ThreadPoolExecutor
+
+executor = ThreadPoolExecutor(config.get('password_threads', 2), name='credentials')
+
+def run(func, *args, **kwargs):
+    """Like db.run(), but for hashing passwords."""
+    executor.run(func, *args, **kwargs)
+
+if hasattr(hmac, 'compare_digest'):
+    constant_time_compare = hmac.compare_digest
+else:
+    def constant_time_compare(a, b):
+        if len(a) != len(b):
+            return False
+        result = 0
+        for x, y in zip(a, b):
+            result |= ord(x) ^ ord(y)
+        return result == 0
+
+def _encode(password):
+    if isinstance(password, unicode):
+        return password.encode('utf-8')
+    return password
+
+class LegacySHA1(object):
+    """The original scheme: the hex encoding of an 8 byte salt followed by
+    sha1(salt + password). These hashes have no scheme prefix.
+    """
+
+    name = 'sha1'
+
+    def verify(self, password, stored):
+        try:
+            raw = stored.decode('hex')
+        except TypeError:
+            return False
+        return constant_time_compare(hashlib.sha1(raw[:8] + _encode(password)).digest(), raw[8:])
+
+    def needs_rehash(self, stored):
+        return True
+
+class PBKDF2(object):
+    """PBKDF2-HMAC with a random 16 byte salt. The parameter is the iteration
+    count, which defaults to the password_iterations config.
+    """
+
+    def __init__(self, digest='sha256'):
+        self.digest = digest
+        self.name = 'pbkdf2_' + digest
+
+    @property
+    def iterations(self):
+        return config.get('password_iterations', 50000)
+
+    def derive(self, password, salt, iterations):
+        return hashlib.pbkdf2_hmac(self.digest, _encode(password), salt, iterations)
+
+    def hash(self, password):
+        salt = os.urandom(16)
+        key = self.derive(password, salt, self.iterations)
+        return '%s$%d$%s$%s' % (self.name, self.iterations, binascii.hexlify(salt), binascii.hexlify(key))
+
+    def _parse(self, stored):
+        _, iterations, salt, key = stored.split('$')
+        return int(iterations), binascii.unhexlify(salt), binascii.unhexlify(key)
+
+    def verify(self, password, stored):
+        try:
+            iterations, salt, key = self._parse(stored)
+        except (ValueError, TypeError):
+            return False
+        return constant_time_compare(self.derive(password, salt, iterations), key)
+
+    def needs_rehash(self, stored):
+        iterations, _, _ = self._parse(stored)
+        return stored.split('$', 1)[0] != current_scheme().name or iterations < self.iterations
+
+SCHEMES = {}
+for scheme in (PBKDF2('sha256'), PBKDF2('sha512')):
+    SCHEMES[scheme.name] = scheme
+del scheme
+
+LEGACY_SCHEME = LegacySHA1()
+
+def current_scheme():
+    """Get the scheme that new passwords are hashed with, which is set with
+    the password_scheme config.
+    """
+    return SCHEMES[config.get('password_scheme', 'pbkdf2_sha256')]
+
+def get_scheme(stored):
+    if '$' not in stored:
+        return LEGACY_SCHEME
+    return SCHEMES.get(stored.split('$', 1)[0])
+
+def hash_password(password):
+    return current_scheme().hash(password)
+
+def check_password(password, stored):
+    """Check a password against a stored hash. Returns a tuple of whether the
+    password is correct, and if it is, a new hash to replace the stored one
+    with (or None if the stored hash is up to date).
+
+    If stored is None (e.g. because there's no such user) a hash is still
+    computed, so that the time taken doesn't reveal whether the user exists.
+    """
+    if stored is None:
+        hash_password(password)
+        return False, None
+    scheme = get_scheme(stored)
+    if scheme is None or not scheme.verify(password, stored):
+        return False, None
+    if scheme.needs_rehash(stored):
+        return True, hash_password(password)
+    return True, None
@@ -1,11 +1,13 @@
-import base64
 import binascii
 import hashlib
 import os
+import string
 import struct
 from Crypto.Cipher import DES3
 
 from graff import config
+from graff import metrics
+from graff.util import LRUCache
 
 crypto_secret = config.get('crypto_secret', None)
 if crypto_secret is not None:
@@ -44,6 +46,7 @@ def decrypt_blob(ciphertext, key):
     (bloblen,) = struct.unpack('!I', plainbuf[:BLOB_LEN_SIZE])
     return plainbuf[BLOB_LEN_SIZE:][:bloblen]
 
+@metrics.CRYPTO_SECONDS.time(op='encrypt_string')
 def encrypt_string(plaintext, key=None):
     key = key or crypto_secret
     # plaintext must be a string
@@ -53,17 +56,48 @@ def encrypt_string(plaintext, key=None):
     padded_buffer = plaintext + padding
     return encrypt_buffer(padded_buffer, key)
 
+@metrics.CRYPTO_SECONDS.time(op='decrypt_string')
 def decrypt_string(ciphertext, key):
     key = key or crypto_secret
     plaintext = decrypt_buffer(ciphertext, key)
     return plaintext.rstrip(PADDING_CHAR)
 
+# DES3 key schedules are relatively expensive to set up, so there's one ECB
+# cipher per key, and CBC mode is done on top of that by cbc_encrypt() and
+# cbc_decrypt()
+_ciphers = {}
+
+def get_cipher(key):
+    try:
+        return _ciphers[key]
+    except KeyError:
+        cipher = _ciphers[key] = DES3.new(key, DES3.MODE_ECB)
+        return cipher
+
+def xor_blocks(a, b):
+    fmt = '!%dQ' % (len(a) // BLOCK_SIZE)
+    return struct.pack(fmt, *[x ^ y for x, y in zip(struct.unpack(fmt, a), struct.unpack(fmt, b))])
+
+def cbc_encrypt(key, iv, plaintext):
+    cipher = get_cipher(key)
+    blocks = []
+    prev = iv
+    for i in xrange(0, len(plaintext), BLOCK_SIZE):
+        prev = cipher.encrypt(xor_blocks(plaintext[i:i + BLOCK_SIZE], prev))
+        blocks.append(prev)
+    return ''.join(blocks)
+
+def cbc_decrypt(key, iv, ciphertext):
+    # each plaintext block is the decrypted ciphertext block xor'ed with the
+    # previous ciphertext block, so this can all be done at once
+    return xor_blocks(get_cipher(key).decrypt(ciphertext), iv + ciphertext[:-BLOCK_SIZE])
+
 # buffer must be padded to crypter.block_size
 def encrypt_buffer(buffer, key, half_aligned=False):
     # buffer must be a string
     assert isinstance(buffer, str)
-    # create crypter with key and initialization vector (generated as a hash of buffer and key)
-    crypter = DES3.new(key, DES3.MODE_CBC, hashlib.sha1(buffer+key).digest()[:IV_SIZE])
+    # initialization vector is generated as a hash of buffer and key
+    iv = hashlib.sha1(buffer+key).digest()[:IV_SIZE]
 
     # compute hash of padded buffer
     bufferHash = hashlib.sha1(buffer).digest()
@@ -72,8 +106,8 @@ def encrypt_buffer(buffer, key, half_aligned=False):
     else:
         bufferHash = bufferHash[:HASH_SIZE]
 
-    # encrypt the buffer, prepend the IV, and return everything base64'd (minus the trailing newline)
-    return trim_base64(base64.encodestring(crypter.IV + crypter.encrypt(buffer + bufferHash)))
+    # encrypt the buffer, prepend the IV, and return everything base64'd
+    return b64encode_token(iv + cbc_encrypt(key, iv, buffer + bufferHash))
 
 # decrypt our base64 (non-standard) encrypted buffer
 def decrypt_buffer(buffer, key, half_aligned=False):
@@ -83,13 +117,13 @@ def decrypt_buffer(buffer, key, half_aligned=False):
     assert isinstance(buffer, str)
 
     # decode from base64
-    tmp = base64.decodestring(fatten_base64(buffer))
-
-    # create crypter with given key, and IV extracted from buffer
-    crypter = DES3.new(key, DES3.MODE_CBC, tmp[:IV_SIZE])
+    tmp = b64decode_token(buffer)
 
-    # decrypt the buffer after the IV
-    plaintext = crypter.decrypt(tmp[IV_SIZE:])
+    # decrypt the buffer after the IV, using the IV extracted from the buffer
+    ciphertext = tmp[IV_SIZE:]
+    if not ciphertext or len(ciphertext) % BLOCK_SIZE:
+        raise InvalidEncryptedId('encrypted buffer is not block aligned')
+    plaintext = cbc_decrypt(key, tmp[:IV_SIZE], ciphertext)
 
     # verify that the hash of the fields matches the hash included in the buffer
     if half_aligned:
@@ -101,21 +135,30 @@ def decrypt_buffer(buffer, key, half_aligned=False):
 
     return plaintext[:-hs]
 
+# note that this isn't the same mapping as base64.urlsafe_b64encode()
+_to_url_safe = string.maketrans('+/', '_-')
+_from_url_safe = string.maketrans('_-', '+/')
+
 # remove the dreaded = signs, they are a huge pain, remap non-url-safe tokens
 def trim_base64(b64):
-    b64 = b64.replace('\n', '')
-    b64 = b64.replace('=', '')
-    b64 = b64.replace('+', '_')
-    b64 = b64.replace('/', '-')
-    return b64
+    return b64.replace('\n', '').rstrip(BASE64_PADDING_CHAR).translate(_to_url_safe)
 
 # add back the '=' padding and fix remap url-safe tokens
 def fatten_base64(buffer):
-    buffer = buffer.replace('_', '+')
-    buffer = buffer.replace('-', '/')
-
     padding = BASE64_PADDING_CHAR * (BASE64_BLOCK_SIZE - (len(buffer) % BASE64_BLOCK_SIZE))
-    return buffer + padding
+    return buffer.translate(_from_url_safe) + padding
+
+def b64encode_token(raw):
+    """Encode a buffer in our url-safe, unpadded base64 format. This is the
+    same as trim_base64(base64.encodestring(raw)).
+    """
+    return binascii.b2a_base64(raw)[:-1].rstrip(BASE64_PADDING_CHAR).translate(_to_url_safe)
+
+def b64decode_token(token):
+    """Decode a token made by b64encode_token(); raises binascii.Error if the
+    token is malformed.
+    """
+    return binascii.a2b_base64(token.translate(_from_url_safe) + BASE64_PADDING_CHAR * (-len(token) % 4))
 
 
 _encid_formats = ('!I', '!Q')
@@ -123,6 +166,7 @@ _encid_formats = ('!I', '!Q')
 # size in bytes that all tokens should be
 _encid_sizes = (22, 32)
 
+@metrics.CRYPTO_SECONDS.time(op='encid')
 def encid_core(id, sixtyfour, key):
     if not isinstance(id, (int, long)):
         raise TypeError("Can only encrypt integers but got: %s (%s)" % (id, type(id)))
@@ -134,6 +178,7 @@ def encid_core(id, sixtyfour, key):
         raise ValueError('Got integer %d, invalid for struct format %r' % (id, _encid_formats[int(bool(sixtyfour))]))
     return encrypt_buffer(buf, key, not sixtyfour)
 
+@metrics.CRYPTO_SECONDS.time(op='decid')
 def decid_core(id, sixtyfour, key):
     # check to make sure the token is of correct length
     if id is None:
@@ -160,8 +205,79 @@ def decid_core(id, sixtyfour, key):
     # unpack and return the id
     return struct.unpack(_encid_formats[int(bool(sixtyfour))], buf)[0]
 
+# Tokens for the same id are always the same, so encid() and decid() are
+# memoized. Only valid tokens are remembered by decid().
+_encid_cache = LRUCache(config.get('encid_cache_size', 65536))
+_decid_cache = LRUCache(config.get('encid_cache_size', 65536))
+
 def encid(num, key=None):
-    return encid_core(num, False, key or crypto_secret)
+    key = key or crypto_secret
+    token = _encid_cache.get((key, num))
+    if token is None:
+        token = encid_core(num, False, key)
+        _encid_cache[(key, num)] = token
+    return token
 
 def decid(num, key=None):
-    return decid_core(num, False, key or crypto_secret)
+    key = key or crypto_secret
+    row_id = _decid_cache.get((key, num))
+    if row_id is None:
+        row_id = decid_core(num, False, key)
+        _decid_cache[(key, num)] = row_id
+    return row_id
+
+@metrics.CRYPTO_SECONDS.time(op='encid_many')
+def encid_many(nums, key=None):
+    """Encrypt a list of ids, as encid() would. The 32-bit token format is a
+    single cipher block, so this encrypts directly with the key's cipher.
+    """
+    key = key or crypto_secret
+    cipher = get_cipher(key)
+    sha1 = hashlib.sha1
+    tokens = []
+    for num in nums:
+        token = _encid_cache.get((key, num))
+        if token is None:
+            if not isinstance(num, (int, long)):
+                raise TypeError("Can only encrypt integers but got: %s (%s)" % (num, type(num)))
+            try:
+                buf = struct.pack(_encid_formats[0], num)
+            except struct.error:
+                raise ValueError('Got integer %d, invalid for struct format %r' % (num, _encid_formats[0]))
+            iv = sha1(buf + key).digest()[:IV_SIZE]
+            block = buf + sha1(buf).digest()[:HALF_HASH_SIZE]
+            token = b64encode_token(iv + cipher.encrypt(xor_blocks(block, iv)))
+            _encid_cache[(key, num)] = token
+        tokens.append(token)
+    return tokens
+
+@metrics.CRYPTO_SECONDS.time(op='decid_many')
+def decid_many(tokens, key=None):
+    """Decrypt a list of tokens, as decid() would. Like encid_many(), this
+    decrypts each token's single block directly with the key's cipher. Raises
+    InvalidEncryptedId if any of the tokens are invalid.
+    """
+    key = key or crypto_secret
+    cipher = get_cipher(key)
+    sha1 = hashlib.sha1
+    ids = []
+    for token in tokens:
+        row_id = _decid_cache.get((key, token))
+        if row_id is None:
+            if not isinstance(token, basestring):
+                raise InvalidEncryptedId("Can't decrypt values of type %s: %s" % (type(token), repr(token)[:100]))
+            try:
+                raw = b64decode_token(str(token))
+            except (UnicodeEncodeError, binascii.Error), e:
+                raise InvalidEncryptedId("Error: '%r'" % (e,))
+            if len(token) != _encid_sizes[0] or len(raw) != IV_SIZE + BLOCK_SIZE:
+                raise InvalidEncryptedId("encrypted id is wrong size: '%s' (%u)" % (token, _encid_sizes[0]))
+            iv = raw[:IV_SIZE]
+            block = xor_blocks(cipher.decrypt(raw[IV_SIZE:]), iv)
+            buf = block[:-HALF_HASH_SIZE]
+            if sha1(buf).digest()[:HALF_HASH_SIZE] != block[-HALF_HASH_SIZE:]:
+                raise InvalidEncryptedId('encrypted hash does not match')
+            row_id = struct.unpack(_encid_formats[0], buf)[0]
+            _decid_cache[(key, token)] = row_id
+        ids.append(row_id)
+    return ids
@@ -1,29 +1,184 @@
+import atexit
+import binascii
+import calendar
+import collections
 import datetime
-import hashlib
+import heapq
 import os
-from sqlalchemy import create_engine, func, Column, ForeignKey
+import sys
+import tempfile
+import threading
+import time
+from sqlalchemy import create_engine, event, func, or_, Column, ForeignKey, Index
 from sqlalchemy.types import Integer, String, Float, DateTime, Boolean
-from sqlalchemy.orm import sessionmaker, relationship, backref
+from sqlalchemy.orm import sessionmaker, relationship, backref, joinedload
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.pool import QueuePool
 import warnings
 
 from graff import config
+from graff import credentials
 from graff import crypto
 from graff import geo
+from graff import metrics
+from graff import spatial
+from graff.executor import ThreadPoolExecutor
+from graff.util import TTLCache
+
+# counters for the connection pool, see pool_stats()
+pool_metrics = {
+    'connects': 0,
+    'checkouts': 0,
+    'checkins': 0,
+    'checkout_wait': 0.0,
+    'checkout_wait_max': 0.0,
+    }
+
+class TimedQueuePool(QueuePool):
+    """A QueuePool that records how long checkouts wait for a connection."""
+
+    def _do_get(self):
+        start = time.time()
+        try:
+            return QueuePool._do_get(self)
+        finally:
+            waited = time.time() - start
+            pool_metrics['checkout_wait'] += waited
+            pool_metrics['checkout_wait_max'] = max(pool_metrics['checkout_wait_max'], waited)
+
+_pool_options = {
+    'poolclass': TimedQueuePool,
+    'pool_size': config.get('db_pool_size', 5),
+    'max_overflow': config.get('db_max_overflow', 10),
+    'pool_timeout': config.get('db_pool_timeout', 30),
+    'pool_recycle': config.get('db_pool_recycle', 3600),
+    }
 
 if config.get('memory', True):
-    engine = create_engine('sqlite:///:memory:')
+    # A throwaway sqlite database. It's kept in a temporary file rather than
+    # in memory (where each connection would get a database of its own), so
+    # that every session gets its own connection and transaction, and queries
+    # are run in the database threads just as they are with MySQL.
+    fd, memory_db_path = tempfile.mkstemp(prefix='graff-', suffix='.db')
+    os.close(fd)
+    atexit.register(os.unlink, memory_db_path)
+    engine = create_engine('sqlite:///' + memory_db_path, connect_args={'check_same_thread': False},
+                           **_pool_options)
     now = func.datetime()
 else:
     engine = create_engine('mysql+mysqldb://' +
                            config.get('db_user', 'graff') + ':' +
                            config.get('db_pass', 'gr4ff') + '@' +
                            config.get('db_host', '127.0.0.1') + '/' +
-                           config.get('db_schema', 'graff'), pool_recycle=3600)
+                           config.get('db_schema', 'graff'),
+                           **_pool_options)
     now = func.now()
 
 Session = sessionmaker(bind=engine)
 
+# Blocking queries are run in this pool of threads, see run(). It shouldn't
+# have more threads than there are connections in the pool.
+executor = ThreadPoolExecutor(config.get('db_threads', config.get('db_pool_size', 5)), name='db')
+
+def run(func, *args, **kwargs):
+    """Call func(*args, **kwargs) in the database thread pool, passing the
+    result to the callback keyword argument on the IOLoop. This is meant to be
+    used with gen.Task, e.g.
+
+        photo = yield gen.Task(db.run, db.Photo.by_id, self.session, photo_id)
+
+    The function shouldn't return anything that will run more queries when
+    it's used (like a Query, or objects with unloaded relationships), since
+    those queries would then block the IOLoop.
+    """
+    executor.run(func, *args, **kwargs)
+
+def close_session(session, commit=False):
+    """Commit a session if commit is true, and then close it, which rolls back
+    anything uncommitted and returns its connection to the pool. This is meant
+    to be called with run(). Returns the sys.exc_info() of the commit if it
+    failed, or None.
+    """
+    try:
+        if commit:
+            session.commit()
+    except Exception:
+        return sys.exc_info()
+    finally:
+        session.close()
+    return None
+
+@event.listens_for(engine, 'connect')
+def _count_connect(dbapi_connection, connection_record):
+    pool_metrics['connects'] += 1
+
+@event.listens_for(engine, 'checkout')
+def _count_checkout(dbapi_connection, connection_record, connection_proxy):
+    pool_metrics['checkouts'] += 1
+
+@event.listens_for(engine, 'checkin')
+def _count_checkin(dbapi_connection, connection_record):
+    pool_metrics['checkins'] += 1
+
+def pool_stats():
+    """Get the connection pool's counters, along with its current state
+    where the pool class reports it.
+    """
+    stats = dict(pool_metrics)
+    pool = engine.pool
+    for name in ('size', 'checkedin', 'checkedout', 'overflow'):
+        method = getattr(pool, name, None)
+        if method is not None:
+            stats[name] = method()
+    return stats
+
+_query_counters = []
+
+@event.listens_for(engine, 'before_cursor_execute')
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    context._query_start = time.time()
+    for counter in _query_counters:
+        counter.count += 1
+        counter.statements.append(statement)
+
+@event.listens_for(engine, 'after_cursor_execute')
+def _time_query(conn, cursor, statement, parameters, context, executemany):
+    metrics.DB_QUERY_SECONDS.observe(time.time() - context._query_start)
+
+class QueryCounter(object):
+    """Counts the SQL statements executed while it's active, e.g.
+
+        with QueryCounter() as counter:
+            Photo.most_recent(session, 20).all()
+        assert counter.count == 1
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.statements = []
+
+    def __enter__(self):
+        _query_counters.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        _query_counters.remove(self)
+
+class assert_max_queries(QueryCounter):
+    """A QueryCounter that raises AssertionError on exit if more than
+    max_queries statements were executed.
+    """
+
+    def __init__(self, max_queries):
+        super(assert_max_queries, self).__init__()
+        self.max_queries = max_queries
+
+    def __exit__(self, exc_type, exc_value, tb):
+        super(assert_max_queries, self).__exit__(exc_type, exc_value, tb)
+        if exc_type is None and self.count > self.max_queries:
+            raise AssertionError('expected at most %d queries, but %d were executed:\n%s' %
+                                 (self.max_queries, self.count, '\n'.join(self.statements)))
+
 class _Base(object):
 
     @property
@@ -59,11 +214,61 @@ Base = declarative_base(cls=_Base)
 
 GEOHASH_PRECISION = 12 
 
+# the spatial index used by Photo.nearby_page, see Photo.nearby_index
+_nearby_index = None
+_nearby_index_refreshed = 0
+_nearby_index_lock = threading.Lock()
+
+def epoch(dt):
+    """Convert a (local time) datetime to seconds since the epoch."""
+    return int(time.mktime(dt.timetuple()))
+
+def time_ago(seconds):
+    """Describe how long ago something happened, given its age in seconds."""
+    if seconds < 30:
+        return 'a moment ago'
+    elif seconds < 120:
+        return '1 minute ago'
+    elif seconds < 59 * 60:
+        return '%d minutes ago' % (int(seconds / 60.0),)
+    elif seconds < 120 * 60:
+        return '1 hour ago'
+    elif seconds < 24 * 60 * 60:
+        return '%d hours ago' % (int(seconds / 3600.0),)
+    elif seconds < 2 * 86400:
+        return '1 day ago'
+    else:
+        return '%d days ago' % (int(seconds / 84600.0),)
+
+def photo_json(photo_id, latitude, longitude, time_created, user_name):
+    return _photo_json(crypto.encid(photo_id, Photo.secret_key), latitude, longitude,
+                       time_created, user_name, time.time())
+
+def photos_json(photos):
+    """Serialize a list of photos and PhotoSummary objects, encrypting all of
+    their ids in one batch.
+    """
+    summaries = [p if isinstance(p, PhotoSummary) else p.summary for p in photos]
+    encids = crypto.encid_many([p.id for p in summaries], Photo.secret_key)
+    now = time.time()
+    return [_photo_json(encid, p[1], p[2], p[3], p[4], now) for encid, p in zip(encids, summaries)]
+
+def _photo_json(encid, latitude, longitude, time_created, user_name, now):
+    # time_created is in seconds since the epoch, as in PhotoSummary
+    return {
+        'id': encid,
+        'latitude': latitude,
+        'longitude': longitude,
+        'time_ago': time_ago(now - time_created),
+        'time_created': time_created,
+        'user': user_name
+        }
+
 class Photo(Base):
     __tablename__ = 'photo'
 
     id = Column(Integer, primary_key=True)
-    body_hash = Column(String(40), nullable=False)
+    body_hash = Column(String(40), nullable=False, index=True)
     content_type = Column(String(64), nullable=False)
     fsid = Column(String(32), nullable=False)
     latitude = Column(Float)
@@ -81,55 +286,252 @@ class Photo(Base):
 
     user = relationship('User', backref=backref('photos', order_by=id))
 
+    __table_args__ = (Index('user_time_created', 'user_id', 'time_created'),)
+
+    # the columns that describe the uploaded file itself, and so are the same
+    # for every upload of that file
+    file_columns = ('body_hash', 'content_type', 'fsid', 'latitude', 'longitude',
+                    'geohash', 'make', 'model', 'photo_time', 'photo_height',
+                    'photo_width', 'sensor')
+
+    @classmethod
+    def most_recent(cls, session, limit, before=None):
+        q = session.query(cls).options(joinedload(cls.user))
+        return cls.filter_before(q, before).order_by(cls.time_created.desc(), cls.id.desc()).limit(limit)
+
+    @classmethod
+    def by_user(cls, session, user_id, limit, before=None):
+        """Get a page of a user's photos, newest first. Returns the photos and
+        the cursor for the next page (or None if this is the last page).
+        """
+        q = session.query(cls).filter(cls.user_id == user_id)
+        q = cls.filter_before(q, before).order_by(cls.time_created.desc(), cls.id.desc())
+        return paginate([((p.time_created, p.id), p) for p in q.limit(limit + 1)], limit)
+
+    @classmethod
+    def filter_before(cls, q, before):
+        """Restrict a query to the photos that come after the (time_created,
+        id) cursor before, in newest first order. The redundant condition on
+        time_created alone lets the database do a range scan of an index on
+        time_created.
+        """
+        if before is None:
+            return q
+        time_created, photo_id = before
+        return q.filter(cls.time_created <= time_created).filter(
+            or_(cls.time_created < time_created, cls.id < photo_id))
+
+    @classmethod
+    def by_body_hash(cls, session, body_hash):
+        """Get the most recent upload of a file, or None."""
+        return session.query(cls).filter(cls.body_hash == body_hash).order_by(cls.id.desc()).first()
+
+    @classmethod
+    def create_duplicate(cls, session, original, **kw):
+        """Create a new photo for a re-upload of the same file as original,
+        sharing its stored variants.
+        """
+        for column in cls.file_columns:
+            kw[column] = getattr(original, column)
+        return cls.create(session, **kw)
+
     @property
     def time_ago(self):
-        delta = datetime.datetime.now() - self.time_created
-        if delta < datetime.timedelta(seconds=30):
-            return 'a moment ago'
-        elif delta < datetime.timedelta(seconds=120):
-            return '1 minute ago'
-        elif delta < datetime.timedelta(seconds=59 * 60):
-            return '%d minutes ago' % (int(delta.total_seconds() / 60.0),)
-        elif delta < datetime.timedelta(seconds=120 * 60):
-            return '1 hour ago'
-        elif delta < datetime.timedelta(seconds=24 * 60 * 60):
-            return '%d hours ago' % (int(delta.total_seconds() / 3600.0),)
-        elif delta < datetime.timedelta(seconds=2 * 86400):
-            return '1 day ago'
-        else:
-            return '%d days ago' % (int(delta.total_seconds() / 84600.0),)
+        return time_ago(time.time() - epoch(self.time_created))
 
     @classmethod
-    def get_nearby(cls, session, limit=None, user=None, bounds=None):
-        """Get all of the photos in an area (possibly unbounded). Results are
-        returned in descending order of age (i.e. newest photos first).
+    def nearby_index(cls, session):
+        """Get the in-memory spatial index of photos, or None if it isn't
+        enabled (with the spatial_index config). Photos added by other
+        processes are picked up every spatial_index_refresh seconds.
+
+        Rows can become visible out of order (a transaction that inserted an
+        earlier photo can commit after a later one), so each refresh reads all
+        of the photos created within spatial_index_refresh_slack seconds of
+        the newest one it has seen, and the index skips the ones it has.
+        """
+        global _nearby_index, _nearby_index_refreshed
+        if not config.get('spatial_index', False):
+            return None
+        # this can be called from several of the executor's threads at once,
+        # and only one of them should do the refresh
+        with _nearby_index_lock:
+            if _nearby_index is None:
+                _nearby_index = spatial.SpatialIndex()
+            if time.time() - _nearby_index_refreshed >= config.get('spatial_index_refresh', 5.0):
+                q = session.query(cls.id, cls.geohash, cls.time_created, cls.latitude, cls.longitude, User.name)
+                q = q.outerjoin(cls.user).filter(cls.geohash != None)
+                max_time = _nearby_index.max_time
+                if max_time is not None:
+                    slack = datetime.timedelta(seconds=config.get('spatial_index_refresh_slack', 60.0))
+                    q = q.filter(cls.time_created >= max_time - slack)
+                rows = []
+                for photo_id, geohash, time_created, latitude, longitude, user_name in q.yield_per(10000):
+                    rows.append((photo_id, geohash, time_created, latitude, longitude,
+                                 PhotoSummary(photo_id, latitude, longitude, epoch(time_created), user_name)))
+                    max_time = max(max_time, time_created) if max_time is not None else time_created
+                _nearby_index.add_many(rows)
+                _nearby_index.max_time = max_time
+                _nearby_index_refreshed = time.time()
+        return _nearby_index
+
+    @classmethod
+    def index_photo(cls, photo, user_name):
+        """Add a newly created photo to the spatial index, if it's enabled."""
+        if _nearby_index is not None and photo.geohash is not None:
+            _nearby_index.add(photo.id, photo.geohash, photo.time_created, photo.latitude, photo.longitude,
+                              PhotoSummary(photo.id, photo.latitude, photo.longitude, epoch(photo.time_created), user_name))
+
+    @classmethod
+    def nearby_page(cls, session, limit, user=None, bounds=None, before=None):
+        """Get a page of the photos in an area (possibly unbounded), newest
+        first, as PhotoSummary objects. If before is given, the page starts
+        after that (time_created, id) cursor. Returns the summaries and the
+        cursor for the next page (or None if this is the last page).
+
+        Bounded queries are answered from the spatial index if it's enabled.
+        Otherwise they're done as a range scan on the (geohash, time_created)
+        key for each of the geohash cells covering the bounds, and the results
+        from each cell are merged.
+        """
+        q = session.query(cls.id, cls.latitude, cls.longitude, cls.time_created, User.name).outerjoin(cls.user)
+        found = []
+        for key, row in cls._nearby(session, q, limit + 1, user, bounds, before):
+            if not isinstance(row, PhotoSummary):
+                row = PhotoSummary(row[0], row[1], row[2], epoch(row[3]), row[4])
+            found.append((key, row))
+        return paginate(found, limit)
+
+    @classmethod
+    def _nearby(cls, session, q, limit, user, bounds, before):
+        """Get ((time_created, id), row) pairs for nearby_page(), where the rows
+        are the results of q (or PhotoSummary objects from the spatial index).
         """
         assert limit is not None
-        q = session.query(cls)
+        max_cells = config.get('nearby_max_cells', 12)
         if bounds:
-            hashcode = geo.get_bounding_geohash(bounds['n'], bounds['w'], bounds['s'], bounds['e'])
-            q.filter(cls.geohash.like(hashcode + '%')).filter(cls.latitude <= bounds['n']).filter(cls.latitude >= bounds['s']).filter(cls.longitude >= bounds['w']).filter(cls.longitude <= bounds['e'])
+            index = cls.nearby_index(session)
+            if index is not None:
+                predicate = (lambda p: p.user_name == user) if user else None
+                return index.page(bounds['n'], bounds['w'], bounds['s'], bounds['e'], limit, max_cells,
+                                  predicate, before)
+
+        if user:
+            u = User.by_name(session, user)
+            if u is None:
+                return []
+            q = q.filter(cls.user_id == u.id)
+        q = cls.filter_before(q, before).order_by(cls.time_created.desc(), cls.id.desc())
+        if not bounds:
+            return [((row.time_created, row.id), row) for row in q.limit(limit)]
+
+        n, w, s, e = bounds['n'], bounds['w'], bounds['s'], bounds['e']
+        q = cls.filter_bounds(q, n, w, s, e)
+        photos = []
+        for prefix in geo.cover_bbox(n, w, s, e, max_cells):
+            if prefix:
+                cell_q = q.filter(cls.geohash >= prefix).filter(cls.geohash < prefix + geo.PREFIX_END)
+            else:
+                cell_q = q.filter(cls.geohash != None)
+            photos.extend(((row.time_created, row.id), row) for row in cell_q.limit(limit))
+        return heapq.nlargest(limit, photos, key=lambda pair: pair[0])
+
+    @classmethod
+    def filter_bounds(cls, q, n, w, s, e):
+        q = q.filter(cls.latitude <= n).filter(cls.latitude >= s)
+        if w <= e:
+            return q.filter(cls.longitude >= w).filter(cls.longitude <= e)
+        else:
+            # the bounds cross the antimeridian
+            return q.filter(or_(cls.longitude >= w, cls.longitude <= e))
+
+    @classmethod
+    def get_clusters(cls, session, bounds, user=None, max_clusters=32):
+        """Aggregate the photos in an area by geohash cell, for showing zoomed
+        out maps. The cells are the smallest ones that divide the bounds into
+        at most max_clusters cells. Returns the geohash precision used, and a
+        list of (geohash prefix, count, mean latitude, mean longitude, newest
+        id) tuples.
+        """
+        n, w, s, e = bounds['n'], bounds['w'], bounds['s'], bounds['e']
+        precision = max(geo.cover_precision(n, w, s, e, max_clusters), 1)
+        index = cls.nearby_index(session)
+        if index is not None:
+            predicate = (lambda p: p.user_name == user) if user else None
+            max_cells = config.get('nearby_max_cells', 12)
+            return precision, index.aggregate(n, w, s, e, precision, max_cells, predicate)
+
+        prefix = func.substr(cls.geohash, 1, precision)
+        q = session.query(prefix, func.count(cls.id), func.avg(cls.latitude), func.avg(cls.longitude), func.max(cls.id))
+        q = cls.filter_bounds(q.filter(cls.geohash != None), n, w, s, e)
         if user:
             u = User.by_name(session, user)
-            q.filter(cls.user_id == u.id)
-        return q.order_by(cls.time_created.desc()).limit(limit)
+            if u is None:
+                return precision, []
+            q = q.filter(cls.user_id == u.id)
+        return precision, q.group_by(prefix).all()
+
+    @property
+    def summary(self):
+        return PhotoSummary(self.id, self.latitude, self.longitude, epoch(self.time_created),
+                            self.user.name if self.user_id else None)
+
+    def to_json(self):
+        return photo_json(*self.summary)
+
+def encode_cursor(time_created, photo_id):
+    """Make an opaque token for the (time_created, id) keyset pagination
+    cursor of a photo, i.e. for the page of photos that comes after it.
+    """
+    plaintext = '%d.%d.%d' % (calendar.timegm(time_created.timetuple()), time_created.microsecond, photo_id)
+    return crypto.encrypt_string(plaintext, key=Photo.secret_key)
+
+def decode_cursor(token):
+    """Get the (time_created, id) cursor from a token made by encode_cursor().
+    Raises ValueError if the token isn't valid.
+    """
+    try:
+        seconds, microseconds, photo_id = [int(x) for x in crypto.decrypt_string(token, Photo.secret_key).split('.')]
+    except (ValueError, binascii.Error):
+        raise ValueError('invalid cursor %r' % (token,))
+    return datetime.datetime.utcfromtimestamp(seconds).replace(microsecond=microseconds), photo_id
+
+def paginate(found, limit):
+    """Split up to limit + 1 ((time_created, id), row) pairs into a page of
+    up to limit rows, and the token for the next page (or None if there are no
+    more rows).
+    """
+    if len(found) > limit:
+        next_cursor = encode_cursor(*found[limit - 1][0])
+    else:
+        next_cursor = None
+    return [row for _, row in found[:limit]], next_cursor
+
+def cluster_json(prefix, count, latitude, longitude, photo_id):
+    return {
+        'geohash': prefix,
+        'count': count,
+        'latitude': latitude,
+        'longitude': longitude,
+        'id': crypto.encid(photo_id, Photo.secret_key)
+        }
+
+class PhotoSummary(collections.namedtuple('PhotoSummary', 'id latitude longitude time_created user_name')):
+    """The parts of a photo that are needed to list it. Unlike on Photo,
+    time_created is in seconds since the epoch.
+    """
+
+    __slots__ = ()
 
     def to_json(self):
-        return {
-            'id': self.encid,
-            'latitude': self.latitude,
-            'longitude': self.longitude,
-            'time_ago': self.time_ago,
-            'time_created': int(self.time_created.strftime('%s')),
-            'user': self.user.name if self.user_id else None
-            }
+        return photo_json(*self)
 
 class User(Base):
     __tablename__ = 'user'
 
     id = Column(Integer, primary_key=True)
     name = Column(String, nullable=False)
-    pw_hash = Column(String(56), nullable=False)
+    pw_hash = Column(String(255), nullable=False)
     email = Column(String)
     location = Column(String)
     signup_ip = Column(Integer, nullable=False)
@@ -142,28 +544,66 @@ class User(Base):
             return 'That username has already been taken'
         if kwargs['email'] and session.query(cls).filter(cls.email == kwargs['email']).first() is not None:
             return 'That email has already been registered'
-        with open('/dev/random', 'rb') as devrandom:
-            salt = devrandom.read(8)
-        hashval = hashlib.sha1(salt + kwargs.pop('password').encode('ascii')).digest()
-        kwargs['pw_hash'] = (salt + hashval).encode('hex')
+        # the password can be hashed ahead of time (e.g. in the credentials
+        # executor), in which case pw_hash is passed instead
+        if 'password' in kwargs:
+            kwargs['pw_hash'] = credentials.hash_password(kwargs.pop('password'))
         kwargs['signup_ip'] = kwargs['login_ip'] = kwargs.pop('remote_ip')
         return super(User, cls).create(session, **kwargs)
 
     @classmethod
     def authenticate(cls, session, name, password, remote_ip):
-        row = session.query(cls).filter(cls.name == name).first()
-        if row is None:
-            return None
-        row_hash = row.pw_hash.decode('hex')
-        if hashlib.sha1(str(row_hash[:8]) + password.encode('ascii')).digest() == row_hash[8:]:
-            row.login_ip = remote_ip
+        row = cls.by_name(session, name)
+        valid, new_hash = credentials.check_password(password, row.pw_hash if row else None)
+        if valid:
+            row.logged_in(remote_ip, new_hash)
             return row
         return None
 
+    def logged_in(self, remote_ip, new_hash=None):
+        """Record a successful login, replacing the password hash if it was
+        rehashed.
+        """
+        self.login_ip = remote_ip
+        if new_hash is not None:
+            self.pw_hash = new_hash
+
     @classmethod
     def by_name(cls, session, name):
         return session.query(cls).filter(cls.name == name).first()
 
+    @classmethod
+    def cached_info(cls, user_id):
+        """Get the UserInfo for a user from the cache, or None if it isn't
+        cached.
+        """
+        return _user_cache.get(user_id)
+
+    @classmethod
+    def info_by_id(cls, session, user_id):
+        """Look up the UserInfo for a user, and cache it for user_cache_ttl
+        seconds (see cached_info()). Returns None if there's no such user.
+        """
+        row = session.query(cls.id, cls.name).filter(cls.id == user_id).first()
+        if row is None:
+            return None
+        info = _user_cache[user_id] = UserInfo(*row)
+        return info
+
+    @classmethod
+    def invalidate(cls, user_id):
+        """Drop a user from the UserInfo cache."""
+        _user_cache.pop(user_id)
+
+class UserInfo(collections.namedtuple('UserInfo', 'id name')):
+    """The parts of a user that are needed to handle a request on their
+    behalf.
+    """
+
+    __slots__ = ()
+
+_user_cache = TTLCache(config.get('user_cache_ttl', 60.0), 'user', max_size=config.get('user_cache_size', 10000))
+
 # set up encryption keys
 g = globals()
 crypto_keys = set()
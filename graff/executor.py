@@ -0,0 +1,85 @@
+"""A bounded pool of threads for running blocking calls (mostly database
+queries) off of the IOLoop.
+
+Calls are made with a callback that's run on the IOLoop with the result, which
+makes them usable with gen.Task, e.g.
+
+    photos, next_cursor = yield gen.Task(executor.run, db.Photo.nearby_page, session, 20)
+
+If the call raises, the exception is re-raised on the IOLoop in the stack
+context that run() was called from, so with gen.engine it's thrown into the
+generator at the yield.
+"""
+
+import functools
+import logging
+import os
+import Queue
+import sys
+import threading
+
+import tornado.ioloop
+from tornado import stack_context
+
+class ThreadPoolExecutor(object):
+
+    def __init__(self, max_workers, name='executor'):
+        self.max_workers = max_workers
+        self.name = name
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._pid = None
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.completed = 0
+
+    def _start_threads(self):
+        # Threads don't survive a fork, so they're started when the executor is
+        # first used instead of when it's created (which happens on import).
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._queue = Queue.Queue()
+                self._threads = []
+            while len(self._threads) < self.max_workers:
+                t = threading.Thread(target=self._work, name='%s-%d' % (self.name, len(self._threads)))
+                t.daemon = True
+                t.start()
+                self._threads.append(t)
+
+    def _work(self):
+        while True:
+            func, args, kwargs, on_result, on_error, io_loop = self._queue.get()
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                io_loop.add_callback(functools.partial(on_error, sys.exc_info()))
+            else:
+                io_loop.add_callback(functools.partial(on_result, result))
+            with self._lock:
+                self.completed += 1
+
+    @property
+    def pending(self):
+        """The number of calls that are queued or running."""
+        return self.submitted - self.completed
+
+    def run(self, func, *args, **kwargs):
+        """Call func(*args, **kwargs) in one of the pool's threads. The
+        callback keyword argument is required, and is called on the IOLoop
+        with the result.
+        """
+        callback = kwargs.pop('callback')
+        if self._pid != os.getpid():
+            self._start_threads()
+
+        def reraise(exc_info):
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+        self.submitted += 1
+        self._queue.put((func, args, kwargs,
+                         stack_context.wrap(callback),
+                         stack_context.wrap(reraise),
+                         tornado.ioloop.IOLoop.instance()))
+        if self.pending > self.max_workers:
+            logging.debug('%s has %d calls waiting for a thread', self.name, self.pending - self.max_workers)
@@ -9,17 +9,77 @@ def haversine_dist(lat1, lng1, lat2, lng2, radius=6.3781e6):
                   math.cos(lat1) * math.cos(lat2) *
                   math.sin((lng2 - lng1) / 2.0) ** 2))
 
-def get_bounding_geohash(n, w, s, e):
-    """Get the bounding geohash for a given geobox. The geohash will be the
-    smallest geohash that completely contains the given geobox (and will usually
-    be quite a bit larger).
+# every geohash character is less than this, so prefix + PREFIX_END is an upper
+# bound for all of the geohashes starting with prefix
+PREFIX_END = '~'
+
+# the characters of a geohash, in order
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+def cell_bbox(prefix):
+    """Get the (n, w, s, e) bounds of a geohash cell."""
+    if not prefix:
+        return 90.0, -180.0, -90.0, 180.0
+    bbox = geohash.bbox(prefix)
+    return bbox['n'], bbox['w'], bbox['s'], bbox['e']
+
+def cell_size(precision):
+    """Get the (height, width) in degrees of a geohash cell."""
+    bits = 5 * precision
+    lng_bits = (bits + 1) // 2
+    lat_bits = bits // 2
+    return 180.0 / (1 << lat_bits), 360.0 / (1 << lng_bits)
+
+def _cell_span(lo, hi, origin, size, count):
+    first = int((lo - origin) / size)
+    last = int((hi - origin) / size)
+    return max(first, 0), min(last, count - 1)
+
+def _cover(n, w, s, e, max_cells):
+    """Find the longest geohash length that covers a geobox in at most
+    max_cells cells. Returns (precision, height, width, rows, cols), where rows
+    and cols are the ranges of cell indexes covered, or None if even a
+    precision of one needs too many cells.
     """
-    lat = 0.5 * (n + s)
-    lng = 0.5 * (w + e)
-    gh = geohash.encode(lat, lng)
-    for x in xrange(12, 0, -1):
-        hash_part = gh[:x]
-        bbox = geohash.bbox(hash_part)
-        if (bbox['n'] >= n and bbox['s'] <= s and bbox['w'] <= w and bbox['e'] >= e):
-            return hash_part
-    return ''
+    if w > e:
+        spans = [(w, 180.0), (-180.0, e)]
+    else:
+        spans = [(w, e)]
+
+    best = None
+    for precision in xrange(1, 13):
+        height, width = cell_size(precision)
+        rows = _cell_span(s, n, -90.0, height, int(round(180.0 / height)))
+        cols = [_cell_span(lo, hi, -180.0, width, int(round(360.0 / width))) for lo, hi in spans]
+        if (rows[1] - rows[0] + 1) * sum(c[1] - c[0] + 1 for c in cols) > max_cells:
+            break
+        best = precision, height, width, rows, cols
+    return best
+
+def cover_precision(n, w, s, e, max_cells):
+    """Get the longest geohash length that covers a geobox in at most
+    max_cells cells, or 0 if there isn't one.
+    """
+    best = _cover(n, w, s, e, max_cells)
+    return best[0] if best is not None else 0
+
+def cover_bbox(n, w, s, e, max_cells=12):
+    """Get a list of geohash prefixes whose cells cover a geobox. The prefixes
+    are all of the same length, which is the longest length that needs at most
+    max_cells cells. Geoboxes that cross the antimeridian (w > e) are handled.
+    If the box can't be covered with max_cells cells even at a precision of
+    one, [''] is returned.
+    """
+    best = _cover(n, w, s, e, max_cells)
+    if best is None:
+        return ['']
+
+    precision, height, width, rows, cols = best
+    prefixes = []
+    for row in xrange(rows[0], rows[1] + 1):
+        lat = -90.0 + (row + 0.5) * height
+        for first, last in cols:
+            for col in xrange(first, last + 1):
+                lng = -180.0 + (col + 0.5) * width
+                prefixes.append(geohash.encode(lat, lng, precision=precision))
+    return prefixes
@@ -1,7 +1,8 @@
-import cStringIO as StringIO
+import collections
 import datetime
-import hashlib
+import functools
 import httplib
+import logging
 import os
 import re
 import struct
@@ -11,14 +12,32 @@ import traceback
 import geohash
 import PIL.Image
 from PIL.ExifTags import GPSTAGS, TAGS
-from tornado.escape import url_escape, url_unescape
+from tornado import gen
+from tornado.escape import json_encode, url_escape, url_unescape
 import tornado.template
 import tornado.web
 
 from graff import db
 from graff import config
+from graff import credentials
 from graff import crypto
-from graff.util import inet_aton, detect_mobile, Flash
+from graff import metrics
+from graff import render
+from graff import storage
+from graff import thumbcache
+from graff import upload
+from graff.util import inet_aton, detect_mobile, Flash, LRUCache, TTLCache
+
+# Results of the queries that don't depend on who's asking, such as the most
+# recent uploads. These are cleared whenever this process stores an upload,
+# and otherwise live for response_cache_ttl seconds.
+response_cache = TTLCache(config.get('response_cache_ttl', 5.0), 'response')
+
+# the largest upload request body that's accepted
+upload_max_bytes = config.get('upload_max_bytes', 32 * 1024 * 1024)
+
+# decrypted secure cookies, keyed by (key, cookie value)
+_cookie_cache = LRUCache(config.get('cookie_cache_size', 10000))
 
 class RequestHandler(tornado.web.RequestHandler):
 
@@ -27,7 +46,11 @@ class RequestHandler(tornado.web.RequestHandler):
 
         self._force_rollback = False
         self._session = None
+        self._closing_session = False
         self._force_redirect = None
+        # the user is looked up when it's first needed, see get_user()
+        self._user = None
+        self._user_resolved = False
         flash_cookie = self.get_cookie('flash')
         if flash_cookie:
             self.flash = Flash.load(url_unescape(flash_cookie))
@@ -59,13 +82,6 @@ class RequestHandler(tornado.web.RequestHandler):
         if mobile is None:
             mobile = mobile_cookie == '1'
 
-        user_id = self.get_secure_cookie('s')
-        if user_id:
-            user_id, = struct.unpack('<I', user_id)
-            self.user = db.User.by_id(self.session, user_id)
-        else:
-            self.user = None
-
         # ensure the user has a unique visitor cookie
         if self.get_secure_cookie('v', None) is None:
             self.set_secure_cookie('v', os.urandom(10))
@@ -79,9 +95,62 @@ class RequestHandler(tornado.web.RequestHandler):
             'is_error': False,
             'mobile': mobile,
             'today': datetime.date.today(),
-            'user': self.user
             }
 
+    @property
+    def user_id(self):
+        """The logged in user's id, from the session cookie, or None."""
+        user_id = self.get_secure_cookie('s')
+        if user_id:
+            try:
+                return struct.unpack('<I', user_id)[0]
+            except struct.error:
+                pass
+        return None
+
+    @property
+    def user(self):
+        """The logged in user's UserInfo, or None. Looking up a user that
+        isn't cached takes a query, which only get_user() does; until then
+        this is None for them.
+        """
+        if not self._user_resolved:
+            user_id = self.user_id
+            if user_id is None:
+                self._user_resolved = True
+            else:
+                info = db.User.cached_info(user_id)
+                if info is not None:
+                    self._user, self._user_resolved = info, True
+        return self._user
+
+    def get_user(self, callback):
+        """Look up the logged in user (in the database threads, if they're
+        not cached), and call callback with their UserInfo or None. This is
+        meant to be used with gen.Task.
+        """
+        user = self.user
+        if self._user_resolved:
+            callback(user)
+            return
+
+        def on_user(info):
+            self._user, self._user_resolved = info, True
+            callback(info)
+        db.run(db.User.info_by_id, self.session, self.user_id, callback=on_user)
+
+    def get_cursor(self, name='before'):
+        """Get a photo pagination cursor from an argument made by
+        db.encode_cursor(), or None if the argument wasn't given.
+        """
+        token = self.get_argument(name, None)
+        if not token:
+            return None
+        try:
+            return db.decode_cursor(str(token))
+        except (ValueError, UnicodeError):
+            raise tornado.web.HTTPError(httplib.BAD_REQUEST)
+
     def prepare(self):
         """This has to be done in prepare() instead of initialize(), in order
         for redirects to work with flush().
@@ -112,34 +181,66 @@ class RequestHandler(tornado.web.RequestHandler):
         val = self.get_cookie(name, default)
         if val == default:
             return val
-        try:
-            val = crypto.decrypt_string(val, key=key)
-            if timestamp:
-                val = val[:-struct.calcsize('<I')] # chop off the timestamp
-            return val
-        except ValueError:
-            self.clear_cookie(name)
-            return default
+        plaintext = _cookie_cache.get((key, val))
+        if plaintext is None:
+            try:
+                plaintext = crypto.decrypt_string(val, key=key)
+            except ValueError:
+                self.clear_cookie(name)
+                return default
+            _cookie_cache[(key, val)] = plaintext
+        if timestamp:
+            plaintext = plaintext[:-struct.calcsize('<I')] # chop off the timestamp
+        return plaintext
 
     @property
     def session(self):
+        # the session only checks out a connection when it's first used
         if self._session is None:
             self._session = db.Session()
-            self._session.rollback() # XXX: fixme
         return self._session
 
     def finish(self, chunk=None):
         if self._session is not None:
-            if self._force_rollback or self.request.method != 'POST':
-                self.session.rollback()
-            else:
-                self.session.commit()
+            # the session is committed (for POSTs) and closed in the database
+            # threads, and the request is finished once that's done
+            session, self._session = self._session, None
+            commit = not self._force_rollback and self.request.method == 'POST'
+            self._closing_session = True
+            db.run(db.close_session, session, commit, callback=functools.partial(self._on_session_closed, chunk))
+            return
+        if self._closing_session:
+            # finish() was called again while the session is being closed,
+            # e.g. by send_error() after write_error()
+            if chunk is not None:
+                self.write(chunk)
+            return
         if not self.flash.empty:
             self.set_cookie('flash', url_escape(self.flash.dump()))
         elif 'flash' in self.request.cookies:
             self.clear_cookie('flash')
         return super(RequestHandler, self).finish(chunk)
 
+    def _on_session_closed(self, chunk, exc_info):
+        self._closing_session = False
+        if exc_info is not None:
+            logging.error('failed to commit %s %s', self.request.method, self.request.uri, exc_info=exc_info)
+            self.send_error(httplib.INTERNAL_SERVER_ERROR, exc_info=exc_info)
+            return
+        self.finish(chunk)
+
+    def on_finish(self):
+        super(RequestHandler, self).on_finish()
+        elapsed = self.request.request_time()
+        handler = type(self).__name__
+        metrics.REQUEST_SECONDS.observe(elapsed, handler=handler, method=self.request.method,
+                                        status=self.get_status())
+        slow_request_ms = config.get('slow_request_ms', None)
+        if slow_request_ms is not None and 1000 * elapsed >= slow_request_ms:
+            metrics.SLOW_REQUESTS.inc(handler=handler)
+            logging.warning('slow request: %s %s %s (%s) took %d ms', self.get_status(), self.request.method,
+                            self.request.uri, handler, 1000 * elapsed)
+
     def write_error(self, status_code, **kwargs):
         self._force_rollback = True
         self.set_header('Content-Type', 'text/html')
@@ -148,7 +249,8 @@ class RequestHandler(tornado.web.RequestHandler):
              'flash': self.flash,
              'mobile': self.env['mobile'],
              'is_error': False,
-             'user': self.env['user'],
+             # only a cached user, since this can't wait for a query
+             'user': self.user,
              'title': httplib.responses[status_code],
              }
         if 500 <= status_code <= 599:
@@ -161,7 +263,13 @@ class RequestHandler(tornado.web.RequestHandler):
         return self.finish()
 
     def render(self, name):
-        return super(RequestHandler, self).render(name, **self.env)
+        """Render a template once the logged in user has been looked up. That
+        can take a query, so handlers that render have to be asynchronous.
+        """
+        def on_user(user):
+            self.env['user'] = user
+            super(RequestHandler, self).render(name, **self.env)
+        self.get_user(on_user)
 
 class NotFoundHandler(RequestHandler):
     """Generates an error response with status_code for all requests."""
@@ -169,12 +277,55 @@ class NotFoundHandler(RequestHandler):
     def prepare(self):
         raise tornado.web.HTTPError(httplib.NOT_FOUND)
 
+class StatusHandler(RequestHandler):
+    """Base class for internal status pages, which are only served to local
+    clients (or to anyone in debug mode).
+
+    With xheaders, remote_ip comes from the X-Real-Ip header, which any client
+    can send, so the address of the socket's peer is checked instead. Requests
+    passed on by a local proxy are refused too, since they have a local peer
+    but come from anywhere.
+    """
+
+    def prepare(self):
+        super(StatusHandler, self).prepare()
+        if not (self.settings['debug'] or self.is_local()):
+            raise tornado.web.HTTPError(httplib.FORBIDDEN)
+
+    def is_local(self):
+        address = self.request.connection.address
+        if not address or address[0] not in ('127.0.0.1', '::1'):
+            return False
+        headers = self.request.headers
+        return 'X-Real-Ip' not in headers and 'X-Forwarded-For' not in headers
+
+class PoolStatusHandler(StatusHandler):
+
+    path = '/_status/pool'
+
+    def get(self):
+        self.write(db.pool_stats())
+
+class MetricsStatusHandler(StatusHandler):
+
+    path = '/_status/metrics'
+
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(metrics.expose())
+
 class HomeHandler(RequestHandler):
 
     path = '/'
 
+    @tornado.web.asynchronous
+    @gen.engine
     def get(self):
-        self.env['recent_photos'] = list(db.Photo.most_recent(self.session, 20))
+        recent_photos = response_cache.get('home')
+        if recent_photos is None:
+            recent_photos = yield gen.Task(db.run, lambda: [p.summary for p in db.Photo.most_recent(self.session, 20)])
+            response_cache['home'] = recent_photos
+        self.env['recent_photos'] = recent_photos
         if int(self.get_cookie('mm', 0)) == 0:
             self.env['map_mode'] = 'recent'
         else:
@@ -187,9 +338,12 @@ class SignupHandler(RequestHandler):
 
     path = '/signup'
 
+    @tornado.web.asynchronous
     def get(self):
         self.render('signup.html')
 
+    @tornado.web.asynchronous
+    @gen.engine
     def post(self):
         name = self.get_argument('name')
         if not NAME_RE.match(name):
@@ -213,31 +367,46 @@ class SignupHandler(RequestHandler):
         email = self.get_argument('email', None)
         location = self.get_argument('location', None)
 
-        user = db.User.create(
-            self.session,
-            name = name,
-            password = password,
-            email = email,
-            location = location,
-            remote_ip = inet_aton(self.request.remote_ip)
-            )
-        if isinstance(user, basestring):
-            self.flash.error.append(user)
+        pw_hash = yield gen.Task(credentials.run, credentials.hash_password, password)
+
+        def create():
+            user = db.User.create(
+                self.session,
+                name = name,
+                pw_hash = pw_hash,
+                email = email,
+                location = location,
+                remote_ip = inet_aton(self.request.remote_ip)
+                )
+            if isinstance(user, basestring):
+                return user
+            self.session.commit()
+            return user.id
+
+        user_id = yield gen.Task(db.run, create)
+        if isinstance(user_id, basestring):
+            self.flash.error.append(user_id)
             self.redirect('/signup')
         else:
-            self.session.commit()
-            self.set_secure_cookie('s', struct.pack('<I', user.id))
+            self.set_secure_cookie('s', struct.pack('<I', user_id))
             self.redirect('/user/' + url_escape(name))
 
 class LoginHandler(RequestHandler):
 
     path = '/login'
 
+    @tornado.web.asynchronous
+    @gen.engine
     def post(self):
         name = self.get_argument('name')
         password = self.get_argument('password')
-        user = db.User.authenticate(self.session, name, password, inet_aton(self.request.remote_ip))
-        if user:
+        user = yield gen.Task(db.run, db.User.by_name, self.session, name)
+        # the password is checked (and possibly rehashed) in the credentials
+        # executor; the user's login is recorded when the request finishes
+        valid, new_hash = yield gen.Task(credentials.run, credentials.check_password,
+                                         password, user.pw_hash if user else None)
+        if valid:
+            user.logged_in(inet_aton(self.request.remote_ip), new_hash)
             self.set_secure_cookie('s', struct.pack('<I', user.id))
             self.redirect('/')
         else:
@@ -249,6 +418,8 @@ class LogoutHandler(RequestHandler):
     path = '/logout'
 
     def get(self):
+        if self.user_id is not None:
+            db.User.invalidate(self.user_id)
         self.clear_cookie('s')
         self.flash.info.append('Come back soon!')
         self.redirect('/')
@@ -273,16 +444,71 @@ class UnforceMobileHandler(RequestHandler):
         newhost = 'graffspotting.com' if self.request.host == 'm.graffspotting.com' else self.request.host
         self.redirect(self.request.protocol + '://' + newhost + '/')
 
-def construct_path(fsid, content_type, makedirs=False):
-    p = os.path.join(os.environ.get('TEMPDIR', '/tmp'), 'graff', fsid[:2], fsid[2:4])
-    if makedirs and not os.path.exists(p):
-        os.makedirs(p)
-    return os.path.join(p, fsid[4:])
-
 class UploadHandler(RequestHandler):
+    """Handles photo uploads. Where the server supports it the request body is
+    streamed to us, and the uploaded file is spooled straight to disk as it
+    arrives; otherwise the buffered body is fed through the same parser.
+    """
 
     path = '/upload'
 
+    # the size of the pieces that a buffered request body is parsed in
+    feed_size = 64 * 1024
+
+    def prepare(self):
+        # these have to be set first, since finish() uses them if prepare()
+        # redirects
+        self.upload = None
+        self.upload_error = None
+        self.streamed = False
+        super(UploadHandler, self).prepare()
+        if self._finished:
+            return
+
+        # reject oversized uploads before reading the body, if we can
+        max_bytes = upload_max_bytes
+        try:
+            content_length = int(self.request.headers.get('Content-Length', 0))
+        except ValueError:
+            raise tornado.web.HTTPError(httplib.BAD_REQUEST)
+        if content_length > max_bytes:
+            raise tornado.web.HTTPError(httplib.REQUEST_ENTITY_TOO_LARGE)
+        if hasattr(self.request.connection, 'set_max_body_size'):
+            self.request.connection.set_max_body_size(max_bytes)
+
+        try:
+            boundary = upload.get_boundary(self.request.headers.get('Content-Type', ''))
+        except upload.UploadError:
+            raise tornado.web.HTTPError(httplib.BAD_REQUEST)
+        spool_dir = os.path.join(storage.store_root(), 'spool')
+        if not os.path.exists(spool_dir):
+            os.makedirs(spool_dir)
+        self.upload = upload.MultipartParser(boundary, spool_dir, max_bytes)
+
+    def data_received(self, chunk):
+        self.streamed = True
+        self.feed(chunk)
+
+    def feed(self, chunk):
+        # once the upload has failed the rest of the body is just dropped, and
+        # the error is reported by post()
+        if self.upload_error is not None:
+            return
+        try:
+            self.upload.feed(chunk)
+        except upload.UploadError, e:
+            self.upload_error = e
+            self.upload.discard()
+
+    def finish(self, chunk=None):
+        if self.upload is not None:
+            self.upload.discard()
+        return super(UploadHandler, self).finish(chunk)
+
+    def on_connection_close(self):
+        if self.upload is not None:
+            self.upload.discard()
+
     @staticmethod
     def decode_gps_ref(field):
         return (
@@ -304,96 +530,79 @@ class UploadHandler(RequestHandler):
             lng *= -1
         return lat, lng, geohash.encode(lat, lng, precision=db.GEOHASH_PRECISION)
 
-    def save_versions(self, img, imgtype, outpath):
-
-        def save_img(i, extension):
-            with open(outpath + '.' + extension, 'wb') as f:
-                i.save(f, imgtype)
-
-        # save the original size
-        save_img(img, 'o')
-        img_width, img_height = img.size
-
-        if img_width == img_height:
-            square_img = img.copy()
-        elif img_width > img_height:
-            lhs = int(0.5 * (img_width - img_height))
-            rhs = lhs + img_height
-            square_img = img.crop((lhs, 0, rhs, img_height))
-        else:
-            t = int(0.5 * (img_height - img_width))
-            b = t + img_width
-            square_img = img.crop((0, t, img_width, b))
-
-        assert square_img.size[0] == square_img.size[1]
-
-        #save_img(square_img, 'os')
-
-        def fit_preserve_aspect(im, max_width, max_height):
-            """Resize the image to (max_width, max_height) without cropping or
-            altering the aspect ratio. Returns a new PIL.Image object.
-            """
-            i = im.copy()
-            i.thumbnail((max_width, max_height), PIL.Image.BICUBIC)
-            return i
-
-        save_img(fit_preserve_aspect(img, 900, 600), 'l')
-        save_img(fit_preserve_aspect(square_img, 900, 600), 'ls')
-        save_img(fit_preserve_aspect(img, 150, 100), 'm')
-        save_img(fit_preserve_aspect(square_img, 150, 100), 'ms')
-        save_img(fit_preserve_aspect(img, 32, 32), 't')
-        save_img(fit_preserve_aspect(square_img, 32, 32), 'ts')
-        save_img(fit_preserve_aspect(img, 20, 20), 's')
-        save_img(fit_preserve_aspect(square_img, 20, 20), 'ss')
+    def create_photo(self, create, *args, **kwargs):
+        """Create a photo with create(session, *args, **kwargs) and commit it,
+        returning the new row. This runs in the database threads.
+        """
+        row = create(self.session, *args, **kwargs)
+        self.session.commit()
+        # the commit expires the row, so its columns are loaded again here
+        # rather than on the IOLoop
+        self.session.refresh(row)
+        return row
 
+    @tornado.web.asynchronous
+    @gen.engine
     def post(self):
+        if not self.streamed:
+            body = self.request.body
+            for offset in xrange(0, len(body), self.feed_size):
+                self.feed(body[offset:offset + self.feed_size])
+        if isinstance(self.upload_error, upload.UploadTooLarge):
+            self.send_error(httplib.REQUEST_ENTITY_TOO_LARGE)
+            return
+        elif self.upload_error is not None or not self.upload.done:
+            self.send_error(httplib.BAD_REQUEST)
+            return
         try:
-            img_fields = self.request.files['img']
+            img_fields = self.upload.files['img']
         except KeyError:
             self.send_error(httplib.BAD_REQUEST)
             return
         assert len(img_fields) == 1
-        img_fields = img_fields[0] # XXX: why?
-        body_hash = hashlib.sha1(img_fields['body']).hexdigest()
-        img_file = StringIO.StringIO(img_fields['body'])
-        content_type = img_fields['content_type'].lower()
+        spooled = img_fields[0]
+        body_hash = spooled.hexdigest()
+
+        # if this exact file has been uploaded before (typically a client
+        # retrying an upload), reuse the stored variants instead of decoding
+        # and storing it all over again; unless the earlier upload failed to
+        # render, in which case this one is rendered from scratch
+        user = yield gen.Task(self.get_user)
+        original = yield gen.Task(db.run, db.Photo.by_body_hash, self.session, body_hash)
+        if original is not None and render.has_original(original.fsid):
+            row = yield gen.Task(
+                db.run,
+                self.create_photo,
+                db.Photo.create_duplicate,
+                original,
+                remote_ip = inet_aton(self.request.remote_ip),
+                user_id = user.id if user else None
+                )
+            db.Photo.index_photo(row, user.name if user else None)
+            response_cache.clear()
+            self.redirect('/photo/' + row.encid)
+            return
+
+        content_type = spooled.content_type.lower()
         if content_type == 'application/octet-stream':
-            name = img_fields.get('filename', '').lower()
+            name = spooled.filename.lower()
             if name.endswith('.jpg'):
                 content_type = 'image/jpeg'
             elif name.endswith('.png'):
                 content_type = 'image/png'
-        img = PIL.Image.open(img_file)
+        img = PIL.Image.open(spooled.open())
 
         do_exif = True
+        orientation = 1
         try:
             raw_info = img._getexif()
         except AttributeError:
             do_exif = False
-            lat, lng, make, model, dt, sensor = None, None, None, None, None, None
+            lat, lng, geohash, make, model, dt, sensor = None, None, None, None, None, None, None
         if do_exif:
             raw_exif = img.info['exif']
             info = dict((TAGS.get(k, k), v) for k, v in raw_info.iteritems())
-            if 'Orientation' in info:
-                orientation = info['Orientation']
-                if orientation == 1:
-                    pass
-                elif orientation == 2:
-                    img = img.transpose(PIL.Image.FLIP_LEFT_RIGHT)
-                elif orientation == 3:
-                    img = img.transpose(PIL.Image.ROTATE_180)
-                elif orientation == 4:
-                    img = img.transpose(PIL.Image.FLIP_TOP_BOTTOM)
-                elif orientation == 5:
-                    img = img.transpose(PIL.Image.ROTATE_90)
-                    img = img.transpose(PIL.Image.FLIP_LEFT_RIGHT)
-                elif orientation == 6:
-                    img = img.transpose(PIL.Image.ROTATE_270)
-                elif orientation == 7:
-                    img = img.transpose(PIL.Image.ROTATE_270)
-                    img = img.transpose(PIL.Image.FLIP_LEFT_RIGHT)
-                elif orientation == 8:
-                    img = img.transpose(PIL.Image.ROTATE_90)
+            orientation = info.get('Orientation', 1)
             if 'GPSInfo' in info:
                 lat, lng, geohash = self.decode_gps(info['GPSInfo'])
                 sensor = True
@@ -407,22 +616,21 @@ class UploadHandler(RequestHandler):
             model = info.get('Model')
 
         fsid = os.urandom(16).encode('hex')
-        fspath = construct_path(fsid, content_type, makedirs=True)
-
-        if content_type == 'image/jpeg':
-            pil_type = 'JPEG'
-        elif content_type == 'image/png':
-            pil_type = 'PNG'
-        else:
-            pil_type = None
+        pil_type = render.PIL_TYPES.get(content_type)
 
         if do_exif:
-            with open(fspath + '.exif', 'wb') as f:
-                f.write(raw_exif)
-        self.save_versions(img, pil_type, fspath)
-
-        row = db.Photo.create(
-            self.session,
+            storage.get_storage().put(fsid, 'exif', raw_exif)
+
+        # Only the raw upload is written here; the (rotated) original is
+        # rendered by the render pool once the row has been committed, and the
+        # resized variants are rendered from that on demand.
+        photo_width, photo_height = render.oriented_size(img.size, orientation)
+        spooled.commit(storage.source_path(fsid, makedirs=True))
+
+        row = yield gen.Task(
+            db.run,
+            self.create_photo,
+            db.Photo.create,
             body_hash = body_hash,
             content_type = content_type,
             fsid = fsid,
@@ -432,27 +640,37 @@ class UploadHandler(RequestHandler):
             make = make,
             model = model,
             photo_time = dt,
-            photo_width = img.size[0],
-            photo_height = img.size[1],
+            photo_width = photo_width,
+            photo_height = photo_height,
             remote_ip = inet_aton(self.request.remote_ip),
             sensor = sensor,
-            user_id = self.user.id if self.user else None
+            user_id = user.id if user else None
             )
-        self.session.commit()
+        db.Photo.index_photo(row, user.name if user else None)
+        response_cache.clear()
+        render.render(fsid, pil_type, orientation)
         self.redirect('/photo/' + row.encid)
 
 class PhotoViewHandler(RequestHandler):
 
     path = '/photo/(.*)'
 
+    @tornado.web.asynchronous
+    @gen.engine
     def get(self, photo_id):
         self.env['photo_id'] = photo_id
         try:
-            photo = db.Photo.from_encid(self.session, photo_id)
+            photo = yield gen.Task(db.run, db.Photo.from_encid, self.session, photo_id)
         except crypto.InvalidEncryptedId:
             raise tornado.web.HTTPError(404)
+        if photo is None:
+            raise tornado.web.HTTPError(404)
+        if photo.user_id is not None:
+            # load the uploader now, rather than from the template
+            yield gen.Task(db.run, getattr, photo, 'user')
+        user = yield gen.Task(self.get_user)
         self.env['photo'] = photo
-        if self.user and photo.user and photo.user.id == self.user.id:
+        if user and photo.user and photo.user.id == user.id:
             self.env['own_photo'] = True
         else:
             self.env['own_photo'] = False
@@ -467,54 +685,243 @@ class PhotoViewHandler(RequestHandler):
             self.env['coordinates'] = 'unknown'
         self.render('photo.html')
 
+ETAG_RE = re.compile(r'"[0-9a-f]{40}\.([a-z]+)"$')
+
+def make_etag(body_hash, size):
+    """Get the strong entity tag for a photo variant."""
+    return '"%s.%s"' % (body_hash, size)
+
+RANGE_RE = re.compile(r'bytes=(\d*)-(\d*)$')
+
+def parse_range(header, size):
+    """Parse a single-range HTTP Range header against a resource of the given
+    size. Returns a (start, end) tuple where end is exclusive, or None if the
+    header should be ignored (e.g. a multi-range request, or a range that ends
+    before it starts). Raises ValueError if the range is unsatisfiable.
+    """
+    m = RANGE_RE.match(header.strip())
+    if m is None:
+        return None
+    first, last = m.groups()
+    if first:
+        start = int(first)
+        if last and int(last) < start:
+            # syntactically invalid, so RFC 7233 says to ignore the header
+            return None
+        end = min(int(last) + 1, size) if last else size
+    elif last:
+        # suffix range, i.e. the final N bytes
+        start = max(size - int(last), 0)
+        end = size
+    else:
+        return None
+    if start >= end:
+        raise ValueError('unsatisfiable range %r' % (header,))
+    return start, end
+
+class PhotoFile(collections.namedtuple('PhotoFile', 'fsid content_type body_hash last_modified')):
+    """What PhotoHandler needs to know about a photo to serve its variants."""
+
+    __slots__ = ()
+
+    @classmethod
+    def from_photo(cls, photo):
+        if photo.photo_time:
+            # We don't actually know the camera's timezone (at least not with a
+            # Nexus S), so just guess UTC. We'll be off by at most 12 hours,
+            # anyway.
+            last_modified = photo.photo_time.strftime('%a, %d %b %Y %H:%M:%S UTC')
+        else:
+            # XXX: this is lazy, we ought to be able to get the actual timezone
+            last_modified = photo.time_created.strftime('%a, %d %b %Y %H:%M:%S UTC')
+        return cls(photo.fsid, photo.content_type, photo.body_hash, last_modified)
+
+# PhotoFiles by encrypted photo id. None of the fields can change once a photo
+# has been uploaded, so these never go stale. Disabled by setting
+# photo_memo_size to 0.
+_photo_memo_size = config.get('photo_memo_size', 10000)
+_photo_files = LRUCache(_photo_memo_size) if _photo_memo_size else None
+
 class PhotoHandler(RequestHandler):
 
     path = '/p/(.*)'
 
+    cache_control = 'public, max-age=31536000, immutable'
+
+    # photos are streamed to the client in chunks of this size, waiting for
+    # each chunk to be flushed to the socket before reading the next one
+    chunk_size = 64 * 1024
+
+    @tornado.web.asynchronous
+    @gen.engine
     def get(self, photo_id):
         if '.' in photo_id:
             encid, size = photo_id.split('.')
         else:
             self.redirect('/p/' + photo_id + '.o')
             return
-        try:
-            photo = db.Photo.from_encid(self.session, encid)
-        except crypto.InvalidEncryptedId:
-            raise tornado.web.HTTPError(404)
-        if photo is None:
+        if size not in render.ALL_EXTS:
             raise tornado.web.HTTPError(404)
-        self.set_header('Content-Type', photo.content_type)
 
-        if photo.photo_time:
-            # We don't actually know the camera's timezone (at least not with a
-            # Nexus S), so just guess UTC. We'll be off by at most 12 hours,
-            # anyway.
-            self.set_header('Last-Modified', photo.photo_time.strftime('%a, %d %b %Y %H:%M:%S UTC'))
+        # Photo variants are never modified once they've been written, so any
+        # validator the client has for this URL is still current. That means
+        # revalidation can be answered without looking at the database or the
+        # filesystem.
+        self.set_header('Cache-Control', self.cache_control)
+        etag = self.check_etag(size)
+        if etag is not None or ('If-None-Match' not in self.request.headers and
+                                'If-Modified-Since' in self.request.headers):
+            if etag is not None:
+                self.set_header('Etag', etag)
+            self.set_status(httplib.NOT_MODIFIED)
+            self.finish()
+            return
+
+        info = _photo_files.get(encid) if _photo_files is not None else None
+        if info is None:
+            try:
+                photo_row_id = crypto.decid(encid, db.Photo.secret_key)
+            except crypto.InvalidEncryptedId:
+                raise tornado.web.HTTPError(404)
+            photo = yield gen.Task(db.run, db.Photo.by_id, self.session, photo_row_id)
+            if photo is None:
+                raise tornado.web.HTTPError(404)
+            info = PhotoFile.from_photo(photo)
+            if _photo_files is not None:
+                metrics.PHOTO_MEMO_LOOKUPS.inc(result='miss')
+                _photo_files[encid] = info
         else:
-            # XXX: this is lazy, we ought to be able to get the actual timezone
-            self.set_header('Last-Modified', photo.time_created.strftime('%a, %d %b %Y %H:%M:%S UTC'))
+            metrics.PHOTO_MEMO_LOOKUPS.inc(result='hit')
+        self.set_header('Content-Type', info.content_type)
+        self.set_header('Etag', make_etag(info.body_hash, size))
+        self.set_header('Last-Modified', info.last_modified)
+
+        data = thumbcache.get(info.fsid, size)
+        if data is not None:
+            # the hottest variants are served from here, so they have to be
+            # marked as used or they'd be the first to be evicted from storage
+            render.variant_cache.touch((info.fsid, size), len(data))
+            self.send_file(storage.SliceBlob(data, 0, len(data)), len(data))
+            return
 
-        fspath = construct_path(photo.fsid, photo.content_type) + '.' + size
-        st = os.stat(fspath)
-        self.set_header('Content-Length', st.st_size)
-        with open(fspath, 'rb') as f:
-            self.write(f.read())
+        blob = storage.get_storage().open(info.fsid, size)
+        if blob is None:
+            # the variant hasn't been rendered yet (or was evicted)
+            render.ensure(info.fsid, size, render.PIL_TYPES.get(info.content_type),
+                          functools.partial(self.on_render, info.fsid, size))
+            return
+        self.send_variant(blob, info.fsid, size)
+
+    def on_render(self, fsid, size, rendered):
+        blob = storage.get_storage().open(fsid, size)
+        if blob is None:
+            self.send_error(httplib.NOT_FOUND)
+            return
+        self.send_variant(blob, fsid, size)
+
+    def send_variant(self, blob, fsid, size):
+        if size in render.VARIANT_EXTS:
+            render.variant_cache.touch((fsid, size), blob.size)
+        if thumbcache.cacheable(size, blob.size):
+            data = blob.read()
+            blob.close()
+            thumbcache.put(fsid, size, data)
+            blob = storage.SliceBlob(data, 0, len(data))
+        self.send_file(blob, blob.size)
+
+    def check_etag(self, size):
+        """Check the If-None-Match header for an entity tag that we could have
+        issued for the given size suffix. Returns the matching tag, or None.
+        """
+        header = self.request.headers.get('If-None-Match')
+        if not header:
+            return None
+        for tag in header.split(','):
+            tag = tag.strip()
+            if tag == '*':
+                return tag
+            m = ETAG_RE.match(tag)
+            if m is not None and m.group(1) == size:
+                return tag
+        return None
+
+    def send_file(self, f, file_size):
+        """Send the contents of the open file (or storage.Blob) f to the
+        client, honoring the Range header. The file is closed once it has been
+        sent.
+        """
+        start, end = 0, file_size
+        self.set_header('Accept-Ranges', 'bytes')
+        range_header = self.request.headers.get('Range')
+        if range_header:
+            try:
+                byte_range = parse_range(range_header, file_size)
+            except ValueError:
+                f.close()
+                self.set_status(httplib.REQUESTED_RANGE_NOT_SATISFIABLE)
+                self.set_header('Content-Range', 'bytes */%d' % (file_size,))
+                self.finish()
+                return
+            if byte_range is not None:
+                start, end = byte_range
+                self.set_status(httplib.PARTIAL_CONTENT)
+                self.set_header('Content-Range', 'bytes %d-%d/%d' % (start, end - 1, file_size))
+        self.set_header('Content-Length', end - start)
+        if start:
+            f.seek(start)
+        self._file = f
+        self._remaining = end - start
+        self.send_chunk()
+
+    def send_chunk(self):
+        if self.request.connection.stream.closed():
+            self._file.close()
+            return
+        chunk = self._file.read(min(self.chunk_size, self._remaining))
+        self._remaining -= len(chunk)
+        if not chunk or self._remaining <= 0:
+            self._file.close()
+            self.finish(chunk)
+        else:
+            self.write(chunk)
+            self.flush(callback=self.send_chunk)
+
+    def on_connection_close(self):
+        f = getattr(self, '_file', None)
+        if f is not None:
+            f.close()
 
 class UserHandler(RequestHandler):
 
     path = '/user/(.*)'
 
+    @tornado.web.asynchronous
+    @gen.engine
     def get(self, user_name):
-        target_user = db.User.by_name(self.session, user_name)
+        before = self.get_cursor()
+        page_size = config.get('user_page_size', 50)
+
+        def load():
+            target_user = db.User.by_name(self.session, user_name)
+            if target_user is None:
+                return None, [], None
+            photos, next_cursor = db.Photo.by_user(self.session, target_user.id, page_size, before)
+            return target_user, photos, next_cursor
+
+        target_user, photos, next_cursor = yield gen.Task(db.run, load)
         if target_user is None:
             raise tornado.web.HTTPError(httplib.NOT_FOUND)
         self.env['target_user'] = target_user
+        self.env['photos'] = photos
+        self.env['next_cursor'] = next_cursor
         self.render('user.html')
 
 class PhotosNearbyHandler(RequestHandler):
 
     path = '/photos'
 
+    @tornado.web.asynchronous
+    @gen.engine
     def get(self):
         start = time.time()
         n = self.get_argument('n', None)
@@ -522,7 +929,7 @@ class PhotosNearbyHandler(RequestHandler):
         e = self.get_argument('e', None)
         w = self.get_argument('w', None)
         user = self.get_argument('user', None)
-        limit = min(int(self.get_argument('count', 20)), 60)
+        limit = max(1, min(int(self.get_argument('count', 20)), 60))
         if n is not None and s is not None and e is not None and w is not None:
             bounds = {
                 'n': float(n),
@@ -531,9 +938,37 @@ class PhotosNearbyHandler(RequestHandler):
                 'w': float(w) }
         else:
             bounds = None
-            
-        photos = [p.to_json() for p in db.Photo.get_nearby(self.session, limit=limit, user=user, bounds=bounds)]
-        self.write({'photos': photos, 'time_ms': 1000 * (time.time() - start)})
+
+        if bounds and self.get_argument('cluster', None):
+            max_clusters = min(int(self.get_argument('max_clusters', 32)), 256)
+            precision, cells = yield gen.Task(db.run, db.Photo.get_clusters, self.session, bounds,
+                                              user=user, max_clusters=max_clusters)
+            clusters = [db.cluster_json(*cell) for cell in cells]
+            self.finish({'clusters': clusters, 'precision': precision, 'time_ms': 1000 * (time.time() - start)})
+            return
+
+        before = self.get_cursor()
+        if bounds is None:
+            # unbounded queries are the same for everyone, so the serialized
+            # page of photos can be cached
+            cache_key = ('photos', limit, user, before)
+            page = response_cache.get(cache_key)
+            if page is None:
+                summaries, next_cursor = yield gen.Task(db.run, db.Photo.nearby_page, self.session, limit,
+                                                        user=user, before=before)
+                page = '"photos": %s, "next": %s' % (json_encode(db.photos_json(summaries)), json_encode(next_cursor))
+                response_cache[cache_key] = page
+            self.set_header('Content-Type', 'application/json; charset=UTF-8')
+            self.finish('{%s, "time_ms": %s}' % (page, json_encode(1000 * (time.time() - start))))
+            return
+
+        summaries, next_cursor = yield gen.Task(db.run, db.Photo.nearby_page, self.session, limit,
+                                                user=user, bounds=bounds, before=before)
+        self.finish({'photos': db.photos_json(summaries), 'next': next_cursor,
+                     'time_ms': 1000 * (time.time() - start)})
+
+if hasattr(tornado.web, 'stream_request_body'):
+    UploadHandler = tornado.web.stream_request_body(UploadHandler)
 
 handlers = []
 for v in globals().values():
@@ -10,21 +10,32 @@ if os.isatty(sys.stdin.fileno()):
     parser.add_option('-d', '--debug', action='store_true', default=False)
     parser.add_option('-p', '--port', type='int', default=9000)
     parser.add_option('-n', '--num-procs', type='int', default=0)
-    parser.add_option('--memory', default=False, action='store_true', help='use a sqlite:///:memory: table for the database')
+    parser.add_option('--memory', default=False, action='store_true', help='use a throwaway sqlite database')
     opts, args = parser.parse_args()
     config.load_config(opts.config, memory=opts.memory)
     config.setdefault('cookie_secret', os.urandom(16) if opts.memory else '----------------')
     settings['debug'] = opts.debug
 else:
-    config.load_config(None, memory=False)
+    # GRAFF_MEMORY is for booting the app in --memory mode without a terminal,
+    # e.g. from bench/server.py
+    memory = os.environ.get('GRAFF_MEMORY') == '1'
+    config.load_config(None, memory=memory)
+    if memory:
+        config.setdefault('cookie_secret', os.urandom(16))
     assert config.get('cookie_secret') is not None
+    settings['debug'] = False
 
 settings['cookie_secret'] = config.get('cookie_secret')
 
+import tornado
 import tornado.httpserver
 import tornado.ioloop
+import tornado.process
 import tornado.web
-from graff.handlers import handlers
+from graff import db
+from graff import render
+from graff import thumbcache
+from graff.handlers import handlers, upload_max_bytes
 from graff.ui import modules
 
 def p(name):
@@ -36,10 +47,30 @@ del p
 
 if __name__ == '__main__':
     app = tornado.web.Application(handlers, **settings)
-    server = tornado.httpserver.HTTPServer(app, xheaders=True)
+    server_options = {'xheaders': True}
+    if tornado.version_info >= (3, 0):
+        # Without stream_request_body, UploadHandler only sees a request once
+        # its whole body has been buffered; this makes the connection refuse
+        # an oversized body as soon as its headers have been read.
+        server_options['max_buffer_size'] = upload_max_bytes
+    server = tornado.httpserver.HTTPServer(app, **server_options)
     server.bind(opts.port)
+    # load the spatial index before forking, so each process starts with it,
+    # and create the thumbnail cache that they all share
+    thumbcache.init()
+    if config.get('spatial_index', False):
+        session = db.Session()
+        db.Photo.nearby_index(session)
+        session.close()
+        # don't share database connections with the forked processes
+        db.engine.dispose()
     num_procs = 1 if opts.debug or opts.memory else opts.num_procs
     server.start(num_procs)
+    # the first process tracks the variants left by the previous server, and
+    # renders any raw uploads that it left staged
+    if getattr(tornado.process, 'task_id', lambda: None)() in (None, 0):
+        render.variant_cache.warm()
+        render.recover()
     tornado.ioloop.IOLoop.instance().start()
 else:
     app = tornado.web.Application(handlers, **settings)
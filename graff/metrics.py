@@ -0,0 +1,129 @@
+"""Process-wide counters and latency histograms, which are served in the
+Prometheus text format at /_status/metrics.
+
+Each metric has a fixed set of label names, and keeps a separate series for
+each distinct set of label values, e.g.
+
+    REQUEST_SECONDS.observe(0.012, handler='PhotoHandler', method='GET', status=200)
+
+Every forked server process has its own metrics, so a scraper has to collect
+from each of them (or add them up) to see the whole server.
+"""
+
+import bisect
+import functools
+import threading
+import time
+
+# upper bounds of the histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_metrics = []
+
+class _Metric(object):
+
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._series = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _format_labels(self, key, extra=()):
+        pairs = zip(self.labels, key) + list(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (k, v.replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs)
+
+    def expose(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.kind)]
+        with self._lock:
+            series = sorted(self._series.items())
+        for key, value in series:
+            lines.extend(self._expose_series(key, value))
+        return lines
+
+class Counter(_Metric):
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def _expose_series(self, key, value):
+        return ['%s%s %r' % (self.name, self._format_labels(key), value)]
+
+class Histogram(_Metric):
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # the count in each bucket, then the total count and sum
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[i] += 1
+            series[-1] += value
+
+    def time(self, **labels):
+        """Decorate a function to observe how long each call takes."""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.time()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(time.time() - start, **labels)
+            return wrapper
+        return decorator
+
+    def _expose_series(self, key, series):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), series):
+            cumulative += count
+            lines.append('%s_bucket%s %d' % (self.name, self._format_labels(key, [('le', str(bound))]), cumulative))
+        lines.append('%s_sum%s %r' % (self.name, self._format_labels(key), series[-1]))
+        lines.append('%s_count%s %d' % (self.name, self._format_labels(key), cumulative))
+        return lines
+
+def expose():
+    """Get all of the metrics in the Prometheus text format."""
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.expose())
+    return '\n'.join(lines) + '\n'
+
+REQUEST_SECONDS = Histogram('graff_request_seconds', 'Time taken to handle requests.',
+                            ('handler', 'method', 'status'))
+SLOW_REQUESTS = Counter('graff_slow_requests_total', 'Requests that took longer than slow_request_ms.',
+                        ('handler',))
+DB_QUERY_SECONDS = Histogram('graff_db_query_seconds', 'Time taken to execute SQL statements.')
+CRYPTO_SECONDS = Histogram('graff_crypto_seconds', 'Time spent encrypting and decrypting ids and cookies.',
+                           ('op',), buckets=(0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.005))
+PIL_SECONDS = Histogram('graff_pil_seconds', 'Time render workers spent resizing and encoding photo variants.',
+                        ('variant',))
+RENDER_SECONDS = Histogram('graff_render_seconds', 'Time taken by render tasks in the worker processes.',
+                           ('task', 'result'))
+CACHE_LOOKUPS = Counter('graff_cache_lookups_total', 'Lookups in the response and user caches.',
+                        ('cache', 'result'))
+THUMBCACHE_LOOKUPS = Counter('graff_thumbcache_lookups_total', 'Lookups in the shared thumbnail cache.',
+                             ('result',))
+PHOTO_MEMO_LOOKUPS = Counter('graff_photo_memo_lookups_total', 'Lookups of photo file info by PhotoHandler.',
+                             ('result',))
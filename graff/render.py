@@ -0,0 +1,481 @@
+"""Rendering of photo variants.
+
+Resizing a large upload takes seconds of CPU time, so rendering is done in a
+pool of worker processes rather than on the IOLoop. When an upload is received
+its raw body is staged at storage.source_path(), and the render pool turns that
+into the (rotated) original. The resized variants are only rendered from the
+original the first time they're requested, and are kept in a size-bounded LRU
+cache in storage.
+
+A render that hasn't finished after render_timeout seconds (e.g. because its
+worker process died) is treated as having failed. A raw upload whose render
+fails is retried up to render_retries times, and is then moved to
+storage.failed_path() so that requests for it fail straight away. Raw uploads
+that were never rendered because the server was restarted are picked up again
+by recover().
+"""
+
+import collections
+import cStringIO
+import functools
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+
+import PIL.Image
+import tornado.ioloop
+
+from graff import config
+from graff import metrics
+from graff import storage
+
+# the extension that _pending uses for renders of raw uploads
+SOURCE_EXT = 'src'
+
+# how often to check on renders being done by other processes, and how long to
+# wait for them before giving up
+POLL_INTERVAL = 0.1
+POLL_TIMEOUT = 30.0
+
+# the EXIF tag for the orientation of the camera
+ORIENTATION_TAG = 274
+
+# the transpositions needed to undo each EXIF orientation
+ORIENTATION_TRANSPOSES = {
+    1: (),
+    2: (PIL.Image.FLIP_LEFT_RIGHT,),
+    3: (PIL.Image.ROTATE_180,),
+    4: (PIL.Image.FLIP_TOP_BOTTOM,),
+    5: (PIL.Image.ROTATE_90, PIL.Image.FLIP_LEFT_RIGHT),
+    6: (PIL.Image.ROTATE_270,),
+    7: (PIL.Image.ROTATE_270, PIL.Image.FLIP_LEFT_RIGHT),
+    8: (PIL.Image.ROTATE_90,),
+    }
+
+def oriented_size(size, orientation):
+    """Get the size an image will have once its EXIF orientation has been
+    applied.
+    """
+    if orientation in (5, 6, 7, 8):
+        return size[1], size[0]
+    return size
+
+# The resized variants, as (extension, square, max_width, max_height). Each
+# family (aspect-preserving and square-cropped) is ordered from largest to
+# smallest, since each variant is downscaled from the previous one in its
+# family rather than from the full size image.
+VARIANTS = (
+    ('l', False, 900, 600),
+    ('m', False, 150, 100),
+    ('t', False, 32, 32),
+    ('s', False, 20, 20),
+    ('ls', True, 900, 600),
+    ('ms', True, 150, 100),
+    ('ts', True, 32, 32),
+    ('ss', True, 20, 20),
+    )
+
+# the extension of the version that each variant is rendered from
+PARENTS = {}
+for _square in (False, True):
+    _parent = 'o'
+    for _extension, _is_square, _, _ in VARIANTS:
+        if _is_square == _square:
+            PARENTS[_extension] = _parent
+            _parent = _extension
+del _square, _parent, _extension, _is_square
+
+ALL_EXTS = ('o',) + tuple(v[0] for v in VARIANTS)
+VARIANT_EXTS = frozenset(v[0] for v in VARIANTS)
+
+PIL_TYPES = {
+    'image/jpeg': 'JPEG',
+    'image/png': 'PNG',
+    }
+
+RESAMPLE_FILTERS = {
+    'nearest': PIL.Image.NEAREST,
+    'bilinear': PIL.Image.BILINEAR,
+    'bicubic': PIL.Image.BICUBIC,
+    'antialias': PIL.Image.ANTIALIAS,
+    }
+
+def variant_options(extension):
+    """Get the resample filter and the PIL save() options for a variant.
+
+    These are configured per variant with the variant_options config key,
+    e.g. {'l': {'quality': 90}, 't': {'resample': 'bilinear', 'quality': 60}};
+    anything other than 'resample' is passed through to save().
+    """
+    options = dict(config.get('variant_options', {}).get(extension, {}))
+    resample = RESAMPLE_FILTERS[options.pop('resample', 'bicubic')]
+    return resample, options
+
+def square_crop(img):
+    img_width, img_height = img.size
+    if img_width == img_height:
+        return img
+    elif img_width > img_height:
+        lhs = int(0.5 * (img_width - img_height))
+        rhs = lhs + img_height
+        return img.crop((lhs, 0, rhs, img_height))
+    else:
+        t = int(0.5 * (img_height - img_width))
+        b = t + img_width
+        return img.crop((0, t, img_width, b))
+
+def load_image(f, exts=ALL_EXTS, orientation=1):
+    """Open an image (from a path or a file) to render the given variants
+    from, applying the EXIF orientation. If the original size isn't needed and
+    the image is a JPEG, it is decoded at the smallest scale that is still
+    large enough for all of the requested variants.
+    """
+    img = PIL.Image.open(f)
+    if 'o' not in exts and img.format == 'JPEG':
+        needed = max(max(w, h) for ext, _, w, h in VARIANTS if ext in exts)
+        img.draft(img.mode, (needed, needed))
+    for method in ORIENTATION_TRANSPOSES.get(orientation, ()):
+        img = img.transpose(method)
+    return img
+
+# The time that save_versions() has spent in PIL for each variant, since
+# _render_worker() last collected it. This is accumulated in the worker
+# processes and passed back to the server with each render's result.
+pil_seconds = collections.defaultdict(float)
+
+def save_versions(img, imgtype, fsid, exts=ALL_EXTS):
+    """Save versions of an image: the image itself as the original, and the
+    given variants resized from it.
+    """
+
+    def save_img(i, extension, start):
+        _, options = variant_options(extension)
+        buf = cStringIO.StringIO()
+        i.save(buf, imgtype, **options)
+        pil_seconds[extension] += time.time() - start
+        storage.get_storage().put(fsid, extension, buf.getvalue())
+
+    if 'o' in exts:
+        save_img(img, 'o', time.time())
+
+    for extension, square, max_width, max_height in VARIANTS:
+        if extension not in exts:
+            continue
+        start = time.time()
+        resample, _ = variant_options(extension)
+        current = square_crop(img) if square else img
+        # thumbnail() resizes in place, so it can't work on the image passed in
+        if current is img:
+            current = current.copy()
+        current.thumbnail((max_width, max_height), resample)
+        save_img(current, extension, start)
+
+def render_source(fsid, imgtype, orientation):
+    """Render the original (and any eagerly rendered variants) from the raw
+    upload staged for fsid, and then remove the raw upload. Returns the
+    (extension, size) of each variant that was stored. This runs in a worker
+    process.
+    """
+    srcpath = storage.source_path(fsid)
+    save_versions(load_image(srcpath, ('o',), orientation), imgtype, fsid, ('o',))
+    rendered = []
+    for extension in config.get('eager_variants', ()):
+        rendered.extend(render_variant(fsid, extension, imgtype))
+    os.unlink(srcpath)
+    return rendered
+
+def recover_source(fsid):
+    """Like render_source(), for a raw upload whose render was lost. The type
+    and orientation are worked out from the raw upload itself, since they
+    weren't saved anywhere. This runs in a worker process.
+    """
+    img = PIL.Image.open(storage.source_path(fsid))
+    try:
+        exif = img._getexif() or {}
+    except AttributeError:
+        exif = {}
+    imgtype = img.format if img.format in PIL_TYPES.values() else None
+    return render_source(fsid, imgtype, exif.get(ORIENTATION_TAG, 1))
+
+def render_variant(fsid, extension, imgtype):
+    """Render a single variant from the stored version it's downscaled from
+    (see PARENTS), rendering that first if it isn't in storage. Returns the
+    (extension, size) of each variant that was stored. This runs in a worker
+    process.
+
+    Variants are only ever rendered from the stored bytes of their parent, so
+    that a variant's bytes are the same however and whenever it's rendered
+    (e.g. eagerly, or again after being evicted), as its strong ETag promises.
+    """
+    store = storage.get_storage()
+    parent = PARENTS[extension]
+    rendered = []
+    blob = store.open(fsid, parent)
+    if blob is None and parent != 'o':
+        rendered.extend(render_variant(fsid, parent, imgtype))
+        blob = store.open(fsid, parent)
+    with blob:
+        save_versions(load_image(blob, (extension,)), imgtype, fsid, (extension,))
+    rendered.append((extension, store.size(fsid, extension)))
+    return rendered
+
+def _render_worker(func, *args):
+    # Python 2's Pool.apply_async has no error callback, so exceptions are
+    # returned to the parent process as a formatted traceback instead. The
+    # timings are returned too, since metrics are kept by the server process.
+    pil_seconds.clear()
+    start = time.time()
+    try:
+        error, result = None, func(*args)
+    except Exception:
+        error, result = traceback.format_exc(), None
+    return error, result, time.time() - start, dict(pil_seconds)
+
+class DiskCache(object):
+    """A size-bounded LRU of the rendered variants, keyed by (fsid, extension).
+
+    Each server process tracks the variants that it has served and rendered,
+    so the bound applies per process: with N server processes, storage can
+    hold up to N times max_bytes of variants. A variant can be tracked by
+    several processes, so one process can evict a variant that others still
+    count. They only overcount (and so evict a little early) until they next
+    look for it and forget() it, or until it reaches the end of their LRU.
+
+    Nothing is tracked or evicted if the storage backend doesn't reclaim the
+    space of deleted files (i.e. the packed backend). Evicting a variant and
+    rendering it again would then only make the store grow, whereas keeping
+    every variant once it's rendered bounds the store by the number of photos.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.files = collections.OrderedDict()
+
+    def warm(self):
+        """Start tracking all of the variants already in storage, with the
+        least recently used ones first in line for eviction. Listing a large
+        store takes a while, so it's done in a background thread, and the
+        variants are added behind the ones used in the meantime.
+
+        Only one server process needs to do this, since the variants that it
+        doesn't know about were all rendered by processes that track them.
+        """
+        if not storage.get_storage().reclaims_space:
+            return
+        io_loop = tornado.ioloop.IOLoop.instance()
+
+        def scan():
+            found = []
+            for fsid, ext, size, last_used in storage.get_storage().entries():
+                if ext in VARIANT_EXTS:
+                    found.append((last_used, (fsid, ext), size))
+            found.sort()
+            files = collections.OrderedDict((key, size) for _, key, size in found)
+            io_loop.add_callback(functools.partial(self._add_old, files))
+
+        thread = threading.Thread(target=scan, name='variant-cache-warm')
+        thread.daemon = True
+        thread.start()
+
+    def _add_old(self, files):
+        for key in self.files:
+            files.pop(key, None)
+        files.update(self.files)
+        self.files = files
+        self.total_bytes = sum(files.itervalues())
+        self.evict()
+
+    def touch(self, key, size):
+        """Mark a variant as having just been used."""
+        if not storage.get_storage().reclaims_space:
+            return
+        old_size = self.files.pop(key, 0)
+        self.files[key] = size
+        self.total_bytes += size - old_size
+        self.evict()
+
+    def forget(self, key):
+        """Stop tracking a variant that's no longer in storage."""
+        self.total_bytes -= self.files.pop(key, 0)
+
+    def evict(self):
+        while self.total_bytes > self.max_bytes and len(self.files) > 1:
+            key, size = self.files.popitem(last=False)
+            self.total_bytes -= size
+            storage.get_storage().delete(*key)
+
+# variant_cache_bytes is the bound for each server process (see DiskCache)
+variant_cache = DiskCache(config.get('variant_cache_bytes', 1 << 30))
+
+_pool = None
+
+# map of (fsid, extension) to the callbacks waiting on that render, for renders
+# started by this process
+_pending = {}
+
+def get_pool():
+    """Get the render pool, creating it if necessary. The pool is created
+    lazily so that each forked server process gets its own.
+    """
+    global _pool
+    if _pool is None:
+        _pool = multiprocessing.Pool(config.get('render_procs', None))
+    return _pool
+
+def _submit(key, func, *args):
+    io_loop = tornado.ioloop.IOLoop.instance()
+    # renders of raw uploads are retried, since the raw upload would otherwise
+    # never be rendered; a variant is rendered again whenever it's requested
+    retries = [config.get('render_retries', 2) if key[1] == SOURCE_EXT else 0]
+    # If a worker process dies mid-render, Python 2's Pool never calls back,
+    # so each attempt is given up on after render_timeout seconds. Attempts
+    # are numbered so that a late result from one that was given up on is
+    # ignored.
+    timeout = config.get('render_timeout', 120.0)
+    attempts = [0]
+    timeouts = [None]
+
+    def on_result(n, result):
+        # this is called from one of the pool's threads
+        io_loop.add_callback(functools.partial(on_done, n, result))
+
+    def on_done(n, result):
+        error, _, elapsed, variant_seconds = result
+        metrics.RENDER_SECONDS.observe(elapsed, task=func.__name__, result='error' if error else 'ok')
+        for variant, seconds in variant_seconds.iteritems():
+            metrics.PIL_SECONDS.observe(seconds, variant=variant)
+        if n == attempts[0]:
+            io_loop.remove_timeout(timeouts[0])
+            on_attempt(result)
+
+    def on_timeout(n):
+        if n == attempts[0]:
+            metrics.RENDER_SECONDS.observe(timeout, task=func.__name__, result='timeout')
+            on_attempt(('timed out after %g seconds' % (timeout,), None))
+
+    def on_attempt(result):
+        # nothing more is expected from this attempt
+        attempts[0] += 1
+        error = result[0]
+        if error is not None and retries[0] > 0:
+            retries[0] -= 1
+            logging.warning('retrying render of %s.%s:\n%s', key[0], key[1], error)
+            submit()
+        else:
+            _finish(key, result)
+
+    def submit():
+        n = attempts[0]
+        timeouts[0] = io_loop.add_timeout(time.time() + timeout, functools.partial(on_timeout, n))
+        get_pool().apply_async(_render_worker, (func,) + args, callback=functools.partial(on_result, n))
+    submit()
+
+def _finish(key, result):
+    error, rendered = result[:2]
+    fsid, extension = key
+    if error is not None:
+        logging.error('failed to render %s.%s:\n%s', fsid, extension, error)
+        if extension == SOURCE_EXT:
+            # keep the raw upload around to look at, but out of the way of
+            # wait(), so that requests for the photo fail straight away
+            try:
+                os.rename(storage.source_path(fsid), storage.failed_path(fsid))
+            except OSError:
+                pass
+    else:
+        for variant, size in rendered or ():
+            variant_cache.touch((fsid, variant), size)
+    for callback in _pending.pop(key, []):
+        callback(error is None)
+
+def render(fsid, imgtype, orientation):
+    """Start rendering the original for the raw upload staged for fsid."""
+    key = (fsid, SOURCE_EXT)
+    _pending.setdefault(key, [])
+    _submit(key, render_source, fsid, imgtype, orientation)
+
+def recover():
+    """Start rendering the raw uploads that are still staged. This is for
+    uploads that were never rendered because the server was restarted, so it
+    should be called by just one server process, before any renders have been
+    started.
+    """
+    for fsid in storage.pending_sources():
+        key = (fsid, SOURCE_EXT)
+        if key not in _pending:
+            logging.info('rendering raw upload %s left by a previous server', fsid)
+            _pending[key] = []
+            _submit(key, recover_source, fsid)
+
+def has_original(fsid):
+    """Get whether the original for fsid has been rendered, or is still
+    waiting to be (i.e. its raw upload hasn't failed to render).
+    """
+    return (storage.get_storage().exists(fsid, 'o') or (fsid, SOURCE_EXT) in _pending or
+            os.path.exists(storage.source_path(fsid)))
+
+def wait(fsid, callback):
+    """Wait for a pending render of the original for fsid to finish. The
+    callback is called with True once the render has completed, or with False
+    if the render failed, timed out, or wasn't pending in the first place.
+    """
+    key = (fsid, SOURCE_EXT)
+    if key in _pending:
+        _pending[key].append(callback)
+        return
+
+    srcpath = storage.source_path(fsid)
+    if not os.path.exists(srcpath):
+        callback(False)
+        return
+
+    # the render is being done by another server process, so we just have to
+    # poll for the raw upload being removed
+    io_loop = tornado.ioloop.IOLoop.instance()
+    deadline = time.time() + POLL_TIMEOUT
+
+    def poll():
+        if not os.path.exists(srcpath):
+            callback(True)
+        elif time.time() >= deadline:
+            callback(False)
+        else:
+            io_loop.add_timeout(time.time() + POLL_INTERVAL, poll)
+    io_loop.add_timeout(time.time() + POLL_INTERVAL, poll)
+
+def ensure(fsid, extension, imgtype, callback):
+    """Make sure that a variant of a photo exists, rendering it if necessary.
+    Concurrent requests for the same variant share a single render. The
+    callback is called with True once the variant exists.
+    """
+    store = storage.get_storage()
+    key = (fsid, extension)
+    if key in _pending:
+        _pending[key].append(callback)
+        return
+    if store.exists(fsid, extension):
+        callback(True)
+        return
+    if extension in VARIANT_EXTS:
+        # in case another process evicted it
+        variant_cache.forget(key)
+    if extension == 'o':
+        wait(fsid, callback)
+        return
+
+    _pending[key] = [callback]
+
+    def on_original(rendered):
+        if store.exists(fsid, 'o'):
+            _submit(key, render_variant, fsid, extension, imgtype)
+        else:
+            _finish(key, ('original is missing', None))
+
+    if store.exists(fsid, 'o'):
+        on_original(True)
+    else:
+        wait(fsid, on_original)
@@ -0,0 +1,252 @@
+"""An in-memory index of photo locations, for answering "newest photos in this
+geobox" queries without going to the database.
+
+Photos are kept in two sorted arrays: one of (geohash, time_created, id)
+tuples, so that the photos in a geohash cell are a contiguous slice that can
+be found by bisection, and one of (time_created, id) tuples. A query for the
+newest photos in a box walks back from the newest photo overall, which finds
+them quickly when the box holds a good share of the photos, but gives up and
+scans the cells covering the box once it has visited as many photos as are in
+those cells. So a query visits at most about twice as many photos as the
+smaller of the two ways would.
+
+The count, coordinate sums and newest photo of every cell down to
+AGG_PRECISION are kept too, so that clustering only has to visit the photos in
+the cells along the edges of the box.
+
+Photos are added on the IOLoop while queries are run in the database threads,
+so the index is locked while it's being read or changed. The IOLoop never
+waits for the lock: a photo added during a query is queued, and is added by
+whichever call next takes the lock.
+"""
+
+import bisect
+import collections
+import heapq
+import threading
+
+from graff import geo
+
+# the longest geohash prefixes that cell aggregates are kept for
+AGG_PRECISION = 5
+
+# adding more photos than this at once sorts the arrays, rather than inserting
+# each photo into them
+BULK_ADD = 64
+
+# how a geohash cell relates to a geobox
+OUTSIDE, PARTIAL, INSIDE = range(3)
+
+class SpatialIndex(object):
+
+    def __init__(self):
+        self.keys = []
+        self.times = []
+        self.photos = {}
+        # map of geohash prefix to [count, latitude sum, longitude sum, newest
+        # (time_created, id)] for the prefixes up to AGG_PRECISION long
+        self.cells = {}
+        # the newest time_created loaded by db.Photo.nearby_index()
+        self.max_time = None
+        self.lock = threading.RLock()
+        self.queued = collections.deque()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, photo_id, geohash, time_created, latitude, longitude, value):
+        """Add a photo to the index. The value is what's returned by page()
+        for this photo. Adding a photo that's already indexed does nothing.
+        """
+        self.queued.append((photo_id, geohash, time_created, latitude, longitude, value))
+        if self.lock.acquire(False):
+            try:
+                self._add_queued()
+            finally:
+                self.lock.release()
+
+    def add_many(self, rows):
+        """Add photos from an iterable of (photo_id, geohash, time_created,
+        latitude, longitude, value) tuples.
+        """
+        with self.lock:
+            self._add_queued()
+            self._insert(rows)
+
+    def _add_queued(self):
+        queued = []
+        while self.queued:
+            queued.append(self.queued.popleft())
+        self._insert(queued)
+
+    def _insert(self, rows):
+        added = []
+        for photo_id, geohash, time_created, latitude, longitude, value in rows:
+            if photo_id in self.photos:
+                continue
+            self.photos[photo_id] = (latitude, longitude, value)
+            added.append((geohash, time_created, photo_id))
+            newest = (time_created, photo_id)
+            for i in xrange(min(len(geohash), AGG_PRECISION) + 1):
+                cell = self.cells.get(geohash[:i])
+                if cell is None:
+                    self.cells[geohash[:i]] = [1, latitude, longitude, newest]
+                else:
+                    cell[0] += 1
+                    cell[1] += latitude
+                    cell[2] += longitude
+                    cell[3] = max(cell[3], newest)
+        if len(added) > BULK_ADD:
+            self.keys.extend(added)
+            self.keys.sort()
+            self.times.extend((t, photo_id) for _, t, photo_id in added)
+            self.times.sort()
+        else:
+            for key in added:
+                bisect.insort(self.keys, key)
+                bisect.insort(self.times, key[1:])
+
+    def _slice(self, prefix):
+        return (bisect.bisect_left(self.keys, (prefix,)),
+                bisect.bisect_left(self.keys, (prefix + geo.PREFIX_END,)))
+
+    def scan(self, n, w, s, e, max_cells=12, predicate=None):
+        """Generate (geohash, time_created, id, latitude, longitude, value)
+        for each of the photos in a geobox. If predicate is given, only photos
+        whose value it accepts are generated.
+        """
+        in_box = _box_test(n, w, s, e)
+        keys = self.keys
+        for prefix in geo.cover_bbox(n, w, s, e, max_cells):
+            lo, hi = self._slice(prefix)
+            for i in xrange(lo, hi):
+                geohash, time_created, photo_id = keys[i]
+                latitude, longitude, value = self.photos[photo_id]
+                if in_box(latitude, longitude) and (predicate is None or predicate(value)):
+                    yield geohash, time_created, photo_id, latitude, longitude, value
+
+    def page(self, n, w, s, e, limit, max_cells=12, predicate=None, before=None):
+        """Get ((time_created, id), value) pairs for the newest photos in a
+        geobox, newest first. If before is given, only photos older than that
+        (time_created, id) are included.
+        """
+        with self.lock:
+            self._add_queued()
+            budget = sum(hi - lo for lo, hi in map(self._slice, geo.cover_bbox(n, w, s, e, max_cells)))
+            found = self._walk_newest(n, w, s, e, limit, predicate, before, budget)
+            if found is not None:
+                return found
+            found = (((t, photo_id), value) for _, t, photo_id, _, _, value in self.scan(n, w, s, e, max_cells, predicate)
+                     if before is None or (t, photo_id) < before)
+            return heapq.nlargest(limit, found, key=lambda pair: pair[0])
+
+    def _walk_newest(self, n, w, s, e, limit, predicate, before, budget):
+        """Find the newest photos in a geobox by walking back from the newest
+        photo. Returns None if that takes more than budget photos.
+        """
+        in_box = _box_test(n, w, s, e)
+        times = self.times
+        i = bisect.bisect_left(times, before) if before is not None else len(times)
+        found = []
+        while i > 0 and len(found) < limit:
+            if budget <= 0:
+                return None
+            budget -= 1
+            i -= 1
+            key = times[i]
+            latitude, longitude, value = self.photos[key[1]]
+            if in_box(latitude, longitude) and (predicate is None or predicate(value)):
+                found.append((key, value))
+        return found
+
+    def aggregate(self, n, w, s, e, precision, max_cells=12, predicate=None):
+        """Group the photos in a geobox by geohash cell. Returns a list of
+        (prefix, count, mean latitude, mean longitude, newest id) tuples.
+        """
+        cells = {}
+        with self.lock:
+            self._add_queued()
+            if predicate is None and precision <= AGG_PRECISION:
+                for prefix in geo.cover_bbox(n, w, s, e, max_cells):
+                    for cell_prefix in self._cells_in(prefix, precision, n, w, s, e):
+                        _merge(cells, cell_prefix[:precision], self._aggregate_cell(cell_prefix, n, w, s, e))
+            else:
+                for geohash, time_created, photo_id, latitude, longitude, _ in self.scan(n, w, s, e, max_cells, predicate):
+                    _merge(cells, geohash[:precision], [1, latitude, longitude, (time_created, photo_id)])
+        return [(prefix, count, lat_sum / count, lng_sum / count, newest[1])
+                for prefix, (count, lat_sum, lng_sum, newest) in cells.iteritems()]
+
+    def _cells_in(self, prefix, precision, n, w, s, e):
+        """Generate the non-empty cells of a given precision (or just prefix,
+        if it's longer) in the cell prefix that touch a geobox.
+        """
+        if len(prefix) >= precision:
+            yield prefix
+            return
+        for c in geo.BASE32:
+            child = prefix + c
+            if child in self.cells and _relation(child, n, w, s, e) != OUTSIDE:
+                for cell_prefix in self._cells_in(child, precision, n, w, s, e):
+                    yield cell_prefix
+
+    def _aggregate_cell(self, prefix, n, w, s, e):
+        """Get the [count, latitude sum, longitude sum, newest] of the photos
+        in a cell that are also in a geobox, or None if there aren't any.
+        """
+        relation = _relation(prefix, n, w, s, e)
+        if relation == OUTSIDE:
+            return None
+        if relation == INSIDE and len(prefix) <= AGG_PRECISION:
+            return self.cells.get(prefix)
+        total = None
+        if len(prefix) < AGG_PRECISION:
+            for c in geo.BASE32:
+                if prefix + c in self.cells:
+                    total = _add(total, self._aggregate_cell(prefix + c, n, w, s, e))
+            return total
+        in_box = _box_test(n, w, s, e)
+        lo, hi = self._slice(prefix)
+        for i in xrange(lo, hi):
+            _, time_created, photo_id = self.keys[i]
+            latitude, longitude, _ = self.photos[photo_id]
+            if in_box(latitude, longitude):
+                total = _add(total, [1, latitude, longitude, (time_created, photo_id)])
+        return total
+
+def _box_test(n, w, s, e):
+    """Get a function that tests whether a point is in a geobox."""
+    if w <= e:
+        return lambda lat, lng: s <= lat <= n and w <= lng <= e
+    else:
+        return lambda lat, lng: s <= lat <= n and (lng >= w or lng <= e)
+
+def _relation(prefix, n, w, s, e):
+    """Get whether a geohash cell is OUTSIDE, PARTIAL (overlapping) or INSIDE
+    a geobox.
+    """
+    cell_n, cell_w, cell_s, cell_e = geo.cell_bbox(prefix)
+    spans = [(w, e)] if w <= e else [(w, 180.0), (-180.0, e)]
+    if cell_s > n or cell_n < s or not any(cell_w <= hi and cell_e >= lo for lo, hi in spans):
+        return OUTSIDE
+    if s <= cell_s and cell_n <= n and any(lo <= cell_w and cell_e <= hi for lo, hi in spans):
+        return INSIDE
+    return PARTIAL
+
+def _add(total, cell):
+    """Add up two [count, latitude sum, longitude sum, newest] aggregates,
+    either of which can be None.
+    """
+    if cell is None:
+        return total
+    if total is None:
+        return list(cell)
+    total[0] += cell[0]
+    total[1] += cell[1]
+    total[2] += cell[2]
+    total[3] = max(total[3], cell[3])
+    return total
+
+def _merge(cells, prefix, cell):
+    total = _add(cells.get(prefix), cell)
+    if total is not None:
+        cells[prefix] = total
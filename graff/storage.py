@@ -0,0 +1,388 @@
+"""Storage of the files for each photo: the rendered original and variants,
+and the raw EXIF data. Files are identified by the photo's fsid and an
+extension (e.g. 'o', 't' or 'exif').
+
+There are two backends, chosen with the storage config:
+
+ * 'directory' (the default) stores each file separately, as
+   <store root>/<fsid[:2]>/<fsid[2:4]>/<fsid[4:]>.<ext>
+
+ * 'packed' appends files to large volume files, and keeps an append-only
+   log of where each file is. This avoids having millions of tiny files, and
+   files are read straight out of an mmap of their volume.
+
+Raw uploads are always staged as separate files in a pending directory (see
+source_path()), since they're renamed into place and only exist until they've
+been rendered. Keeping them apart means finding the uploads that still need to
+be rendered doesn't involve walking the whole store.
+"""
+
+import errno
+import fcntl
+import mmap
+import os
+import struct
+import threading
+
+from graff import config
+
+def store_root():
+    return os.path.join(os.environ.get('TEMPDIR', '/tmp'), 'graff')
+
+def fsync_dir(path):
+    """Flush a directory's entries to disk, e.g. to make a rename durable."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def construct_path(fsid, makedirs=False):
+    """Get the path (without an extension) of a photo's files in the
+    directory layout.
+    """
+    p = os.path.join(store_root(), fsid[:2], fsid[2:4])
+    if makedirs and not os.path.exists(p):
+        os.makedirs(p)
+    return os.path.join(p, fsid[4:])
+
+def pending_dir():
+    return os.path.join(store_root(), 'pending')
+
+def source_path(fsid, makedirs=False):
+    """Get the path that a raw upload is staged at until it's rendered."""
+    p = pending_dir()
+    if makedirs and not os.path.exists(p):
+        os.makedirs(p)
+    return os.path.join(p, fsid + '.src')
+
+def failed_path(fsid):
+    """Get the path that a raw upload is moved to if it can't be rendered."""
+    return os.path.join(pending_dir(), fsid + '.failed')
+
+def pending_sources():
+    """Get the fsids of all of the raw uploads that are staged."""
+    try:
+        names = os.listdir(pending_dir())
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return []
+    return [name[:-len('.src')] for name in names if name.endswith('.src')]
+
+class Blob(object):
+    """A read-only file-like view of a stored file, with its size."""
+
+    def __init__(self, size):
+        self.size = size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+class FileBlob(Blob):
+
+    def __init__(self, f):
+        super(FileBlob, self).__init__(os.fstat(f.fileno()).st_size)
+        self.file = f
+        self.read = f.read
+        self.seek = f.seek
+        self.tell = f.tell
+        self.close = f.close
+
+class SliceBlob(Blob):
+    """A blob that's a slice of an mmapped volume."""
+
+    def __init__(self, buf, offset, size):
+        super(SliceBlob, self).__init__(size)
+        self.buf = buf
+        self.offset = offset
+        self.pos = 0
+
+    def read(self, n=-1):
+        if n < 0 or n > self.size - self.pos:
+            n = self.size - self.pos
+        start = self.offset + self.pos
+        self.pos += n
+        return self.buf[start:start + n]
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            pos += self.pos
+        elif whence == os.SEEK_END:
+            pos += self.size
+        self.pos = max(0, min(pos, self.size))
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        self.buf = None
+
+class Storage(object):
+    """The interface to a storage backend."""
+
+    # whether delete() frees the space that the file used
+    reclaims_space = True
+
+    def put(self, fsid, ext, data):
+        """Durably store data as a file, replacing any existing file."""
+        raise NotImplementedError
+
+    def open(self, fsid, ext):
+        """Get a Blob of a file, or None if it doesn't exist."""
+        raise NotImplementedError
+
+    def size(self, fsid, ext):
+        """Get the size of a file, or None if it doesn't exist."""
+        raise NotImplementedError
+
+    def exists(self, fsid, ext):
+        return self.size(fsid, ext) is not None
+
+    def delete(self, fsid, ext):
+        """Remove a file, if it exists."""
+        raise NotImplementedError
+
+    def entries(self):
+        """Generate (fsid, ext, size, last_used) for each stored file. The
+        last_used values order files by how recently they've been used, as
+        well as the backend can tell.
+        """
+        raise NotImplementedError
+
+class DirectoryStorage(Storage):
+
+    def path(self, fsid, ext, makedirs=False):
+        return construct_path(fsid, makedirs) + '.' + ext
+
+    def put(self, fsid, ext, data):
+        path = self.path(fsid, ext, makedirs=True)
+        # write to a temporary file first, so that a partially written file is
+        # never visible to readers
+        tmppath = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmppath, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmppath, path)
+        fsync_dir(os.path.dirname(path))
+
+    def open(self, fsid, ext):
+        try:
+            return FileBlob(open(self.path(fsid, ext), 'rb'))
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+    def size(self, fsid, ext):
+        try:
+            return os.path.getsize(self.path(fsid, ext))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+    def delete(self, fsid, ext):
+        try:
+            os.unlink(self.path(fsid, ext))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def entries(self):
+        root = store_root()
+        for dirpath, dirnames, filenames in os.walk(root):
+            parts = os.path.relpath(dirpath, root).split(os.sep)
+            if len(parts) != 2 or not all(len(part) == 2 for part in parts):
+                continue
+            for name in filenames:
+                rest, _, ext = name.partition('.')
+                if not ext or '.' in ext or ext == 'src':
+                    continue
+                try:
+                    st = os.stat(os.path.join(dirpath, name))
+                except OSError:
+                    continue
+                yield ''.join(parts) + rest, ext, st.st_size, st.st_atime
+
+# An index record: the raw fsid, the extension, and the volume, offset and
+# length of the file. Deleted files have a record with the TOMBSTONE flag.
+INDEX_RECORD = struct.Struct('!16s8sIQIB')
+TOMBSTONE = 1
+
+class PackedStorage(Storage):
+    """Files are appended to volumes (<root>/NNNNNN.vol) of up to
+    packed_volume_bytes, and their locations are appended to <root>/index.
+    Appends from every process are serialized with an flock of the index.
+
+    Each process keeps the whole index in memory, and picks up files written
+    by other processes by reading the new records at the end of the index
+    whenever it looks up a file it doesn't know about.
+
+    Deleting a file only appends a tombstone record; the space in the volume
+    isn't reclaimed, so the variant cache doesn't evict anything from this
+    backend (see render.DiskCache).
+    """
+
+    reclaims_space = False
+
+    def __init__(self, root, volume_bytes):
+        self.root = root
+        self.volume_bytes = volume_bytes
+        if not os.path.exists(root):
+            os.makedirs(root)
+        # flock() locks belong to the open file, so each process has to open
+        # the index itself for the locking to work
+        self._index_fd = os.open(os.path.join(root, 'index'), os.O_RDWR | os.O_CREAT | os.O_APPEND, 0644)
+        self._index_pos = 0
+        # map of (fsid, ext) to (volume, offset, length, sequence number)
+        self._index = {}
+        self._sequence = 0
+        self._maps = {}
+        # the newest volume that this process knows about
+        self._volume = 0
+        # entries() can be called from a background thread (see
+        # render.DiskCache.warm()), so reading the index is serialized
+        self._refresh_lock = threading.Lock()
+        self._refresh()
+
+    def _volume_path(self, volume):
+        return os.path.join(self.root, '%06d.vol' % (volume,))
+
+    def _refresh(self):
+        """Read any records that have been appended to the index."""
+        with self._refresh_lock:
+            self._refresh_locked()
+
+    def _refresh_locked(self):
+        end = os.fstat(self._index_fd).st_size
+        end -= end % INDEX_RECORD.size
+        if end <= self._index_pos:
+            return
+        os.lseek(self._index_fd, self._index_pos, os.SEEK_SET)
+        chunks = []
+        remaining = end - self._index_pos
+        while remaining:
+            chunk = os.read(self._index_fd, remaining)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        data = ''.join(chunks)
+        data = data[:len(data) - len(data) % INDEX_RECORD.size]
+        self._index_pos += len(data)
+        for i in xrange(0, len(data), INDEX_RECORD.size):
+            raw_fsid, ext, volume, offset, length, flags = INDEX_RECORD.unpack_from(data, i)
+            key = (raw_fsid.encode('hex'), ext.rstrip('\0'))
+            if flags & TOMBSTONE:
+                self._index.pop(key, None)
+            else:
+                self._sequence += 1
+                self._index[key] = (volume, offset, length, self._sequence)
+                self._volume = max(self._volume, volume)
+
+    def _lookup(self, fsid, ext):
+        entry = self._index.get((fsid, ext))
+        if entry is None:
+            self._refresh()
+            entry = self._index.get((fsid, ext))
+        return entry
+
+    def _append_record(self, fsid, ext, volume, offset, length, flags=0):
+        """Append to the index. This has to be called with the index locked."""
+        fd = self._index_fd
+        size = os.fstat(fd).st_size
+        if size % INDEX_RECORD.size:
+            # a previous append was interrupted part way through a record
+            os.ftruncate(fd, size - size % INDEX_RECORD.size)
+        os.write(fd, INDEX_RECORD.pack(fsid.decode('hex'), ext, volume, offset, length, flags))
+        os.fsync(fd)
+
+    def put(self, fsid, ext, data):
+        fcntl.flock(self._index_fd, fcntl.LOCK_EX)
+        try:
+            # other processes may have started new volumes since the last put
+            while os.path.exists(self._volume_path(self._volume + 1)):
+                self._volume += 1
+            volume = self._volume
+            path = self._volume_path(volume)
+            if os.path.exists(path) and os.path.getsize(path) + len(data) > self.volume_bytes:
+                volume = self._volume = volume + 1
+                path = self._volume_path(volume)
+            new_volume = not os.path.exists(path)
+            with open(path, 'ab') as f:
+                offset = f.tell()
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            if new_volume:
+                fsync_dir(os.path.dirname(path))
+            self._append_record(fsid, ext, volume, offset, len(data))
+        finally:
+            fcntl.flock(self._index_fd, fcntl.LOCK_UN)
+        self._refresh()
+
+    def _map(self, volume, end):
+        """Get an mmap of a volume that covers at least up to end."""
+        m = self._maps.get(volume)
+        if m is None or len(m) < end:
+            with open(self._volume_path(volume), 'rb') as f:
+                m = self._maps[volume] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return m
+
+    def open(self, fsid, ext):
+        entry = self._lookup(fsid, ext)
+        if entry is None:
+            return None
+        volume, offset, length, _ = entry
+        return SliceBlob(self._map(volume, offset + length), offset, length)
+
+    def read(self, fsid, ext):
+        """Get the contents of a file, or None if it doesn't exist."""
+        entry = self._lookup(fsid, ext)
+        if entry is None:
+            return None
+        volume, offset, length, _ = entry
+        return self._map(volume, offset + length)[offset:offset + length]
+
+    def size(self, fsid, ext):
+        entry = self._lookup(fsid, ext)
+        return entry[2] if entry is not None else None
+
+    def delete(self, fsid, ext):
+        if self._lookup(fsid, ext) is None:
+            return
+        fcntl.flock(self._index_fd, fcntl.LOCK_EX)
+        try:
+            self._append_record(fsid, ext, 0, 0, 0, TOMBSTONE)
+        finally:
+            fcntl.flock(self._index_fd, fcntl.LOCK_UN)
+        self._refresh()
+
+    def entries(self):
+        self._refresh()
+        for (fsid, ext), (_, _, length, sequence) in self._index.items():
+            yield fsid, ext, length, sequence
+
+_storage = None
+
+def get_storage():
+    """Get the configured storage backend. Each process gets its own, since
+    the packed backend has open files and an in-memory index.
+    """
+    global _storage
+    if _storage is None or _storage[0] != os.getpid():
+        backend = config.get('storage', 'directory')
+        if backend == 'directory':
+            storage = DirectoryStorage()
+        elif backend == 'packed':
+            storage = PackedStorage(os.path.join(store_root(), 'packed'),
+                                    config.get('packed_volume_bytes', 1 << 30))
+        else:
+            raise ValueError('unknown storage backend %r' % (backend,))
+        _storage = (os.getpid(), storage)
+    return _storage[1]
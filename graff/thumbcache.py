@@ -0,0 +1,97 @@
+"""A cache of small photo variants in shared memory, so that hot thumbnails are
+served without touching storage.
+
+The cache is an anonymous shared mmap, which is created by init() before the
+server forks so that every server process sees the same cache. It's divided
+into fixed size slots, and each variant can only be stored in the one slot
+that its key hashes to (a newer variant simply replaces whatever was there).
+
+Each slot starts with a header of the key's digest, the data length and the
+data's CRC-32. There's no locking between processes: a writer clears the
+digest before writing the data and then writes the real header, and a reader
+only believes a slot whose digest and CRC both match, so a torn read is just
+a miss.
+"""
+
+import hashlib
+import mmap
+import struct
+import zlib
+
+from graff import config
+from graff import metrics
+
+HEADER = struct.Struct('!20sII')
+EMPTY_HEADER = '\0' * HEADER.size
+
+# the variants that are small enough to be worth caching
+DEFAULT_VARIANTS = ('m', 't', 's', 'ms', 'ts', 'ss')
+
+class SlabCache(object):
+
+    def __init__(self, slots, slot_bytes):
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self.max_item_bytes = slot_bytes - HEADER.size
+        self.buf = mmap.mmap(-1, slots * slot_bytes)
+
+    def _locate(self, fsid, ext):
+        digest = hashlib.sha1(fsid + '.' + ext).digest()
+        slot = struct.unpack_from('!I', digest)[0] % self.slots
+        return digest, slot * self.slot_bytes
+
+    def get(self, fsid, ext):
+        """Get a variant's data, or None if it isn't cached."""
+        digest, offset = self._locate(fsid, ext)
+        slot_digest, length, crc = HEADER.unpack_from(self.buf, offset)
+        if slot_digest != digest or length > self.max_item_bytes:
+            return None
+        start = offset + HEADER.size
+        data = self.buf[start:start + length]
+        if zlib.crc32(data) & 0xffffffff != crc:
+            return None
+        return data
+
+    def put(self, fsid, ext, data):
+        """Cache a variant's data, if it fits in a slot."""
+        if len(data) > self.max_item_bytes:
+            return False
+        digest, offset = self._locate(fsid, ext)
+        start = offset + HEADER.size
+        self.buf[offset:start] = EMPTY_HEADER
+        self.buf[start:start + len(data)] = data
+        self.buf[offset:start] = HEADER.pack(digest, len(data), zlib.crc32(data) & 0xffffffff)
+        return True
+
+_cache = None
+_initialized = False
+_variants = frozenset(config.get('thumbcache_variants', DEFAULT_VARIANTS))
+
+def init():
+    """Create the cache. This should be called before forking, so that the
+    cache is shared; otherwise each process creates its own the first time
+    it's used. It's disabled by setting thumbcache_slots to 0.
+    """
+    global _cache, _initialized
+    _initialized = True
+    slots = config.get('thumbcache_slots', 4096)
+    if slots:
+        _cache = SlabCache(slots, config.get('thumbcache_slot_bytes', 16 * 1024))
+    return _cache
+
+def get(fsid, ext):
+    if not _initialized:
+        init()
+    if _cache is None or ext not in _variants:
+        return None
+    data = _cache.get(fsid, ext)
+    metrics.THUMBCACHE_LOOKUPS.inc(result='hit' if data is not None else 'miss')
+    return data
+
+def cacheable(ext, size):
+    """Whether a variant of the given size would be cached by put()."""
+    return _cache is not None and ext in _variants and size <= _cache.max_item_bytes
+
+def put(fsid, ext, data):
+    if cacheable(ext, len(data)):
+        _cache.put(fsid, ext, data)
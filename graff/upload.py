@@ -0,0 +1,190 @@
+"""Incremental handling of multipart/form-data upload bodies.
+
+Uploaded files are spooled to a temporary file as the body arrives, and are
+hashed as they're written, so that an upload never has to be held in memory
+all at once.
+"""
+
+import hashlib
+import os
+import re
+import tempfile
+
+from tornado.httputil import HTTPHeaders
+
+from graff import storage
+
+# the maximum size of the headers for a single part, and of a non-file field
+MAX_HEADER_BYTES = 16 * 1024
+MAX_FIELD_BYTES = 64 * 1024
+
+BOUNDARY_RE = re.compile(r'boundary=(?:"([^"]+)"|([^;\s]+))')
+DISPOSITION_PARAM_RE = re.compile(r';\s*(\w+)="([^"]*)"')
+
+class UploadError(ValueError):
+    pass
+
+class UploadTooLarge(UploadError):
+    pass
+
+class SpooledFile(object):
+    """A file upload being written to a temporary file, which also computes
+    the SHA-1 of the data written to it.
+    """
+
+    def __init__(self, dirname, filename, content_type, max_bytes):
+        self.filename = filename
+        self.content_type = content_type
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.sha1 = hashlib.sha1()
+        fd, self.path = tempfile.mkstemp(dir=dirname, suffix='.upload')
+        self.file = os.fdopen(fd, 'w+b')
+
+    def write(self, data):
+        self.size += len(data)
+        if self.max_bytes is not None and self.size > self.max_bytes:
+            raise UploadTooLarge('upload is larger than %d bytes' % (self.max_bytes,))
+        self.sha1.update(data)
+        self.file.write(data)
+
+    def hexdigest(self):
+        return self.sha1.hexdigest()
+
+    def open(self):
+        """Get the spooled file, positioned at the start."""
+        self.file.flush()
+        self.file.seek(0)
+        return self.file
+
+    def commit(self, path):
+        """Durably move the spooled file to path."""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.rename(self.path, path)
+        storage.fsync_dir(os.path.dirname(path))
+        self.path = None
+
+    def discard(self):
+        """Remove the spooled file, if it hasn't already been committed."""
+        if self.path is not None:
+            self.file.close()
+            os.unlink(self.path)
+            self.path = None
+
+def get_boundary(content_type):
+    m = BOUNDARY_RE.search(content_type)
+    if m is None:
+        raise UploadError('no multipart boundary in %r' % (content_type,))
+    return m.group(1) or m.group(2)
+
+# parser states
+_BOUNDARY, _HEADERS, _BODY, _DONE = range(4)
+
+class MultipartParser(object):
+    """An incremental multipart/form-data parser. Parts with a filename are
+    written to SpooledFile objects (in .files) as their data arrives; other
+    fields are small, and are collected in memory (in .fields).
+    """
+
+    def __init__(self, boundary, spool_dir, max_file_bytes=None):
+        self.spool_dir = spool_dir
+        self.max_file_bytes = max_file_bytes
+        self.fields = {}
+        self.files = {}
+        self._delimiter = '\r\n--' + boundary
+        # the first boundary isn't preceded by a CRLF, so pretend that it is
+        self._buffer = '\r\n'
+        self._state = _BOUNDARY
+        self._part = None
+
+    @property
+    def done(self):
+        return self._state == _DONE
+
+    def feed(self, data):
+        self._buffer += data
+        while True:
+            if self._state == _BOUNDARY:
+                i = self._buffer.find(self._delimiter)
+                if i < 0:
+                    # discard the preamble, except for what might be the start
+                    # of the delimiter
+                    self._buffer = self._buffer[-len(self._delimiter):]
+                    return
+                end = i + len(self._delimiter)
+                if len(self._buffer) < end + 2:
+                    return
+                suffix = self._buffer[end:end + 2]
+                if suffix == '--':
+                    self._state = _DONE
+                    self._buffer = ''
+                    return
+                elif suffix != '\r\n':
+                    raise UploadError('malformed multipart boundary')
+                self._buffer = self._buffer[end + 2:]
+                self._state = _HEADERS
+            elif self._state == _HEADERS:
+                if self._buffer.startswith('\r\n'):
+                    headers, self._buffer = '', self._buffer[2:]
+                else:
+                    i = self._buffer.find('\r\n\r\n')
+                    if i < 0:
+                        if len(self._buffer) > MAX_HEADER_BYTES:
+                            raise UploadError('multipart headers are too long')
+                        return
+                    headers, self._buffer = self._buffer[:i], self._buffer[i + 4:]
+                self._start_part(HTTPHeaders.parse(headers))
+                self._state = _BODY
+            elif self._state == _BODY:
+                i = self._buffer.find(self._delimiter)
+                if i < 0:
+                    keep = len(self._delimiter) - 1
+                    if len(self._buffer) > keep:
+                        self._part_data(self._buffer[:-keep])
+                        self._buffer = self._buffer[-keep:]
+                    return
+                self._part_data(self._buffer[:i])
+                self._buffer = self._buffer[i:]
+                self._part = None
+                self._state = _BOUNDARY
+            else:
+                return
+
+    def _start_part(self, headers):
+        disposition = headers.get('Content-Disposition', '')
+        params = dict(DISPOSITION_PARAM_RE.findall(disposition))
+        name = params.get('name')
+        if name is None:
+            raise UploadError('multipart part has no name')
+        if 'filename' in params:
+            self._part = SpooledFile(
+                self.spool_dir,
+                params['filename'],
+                headers.get('Content-Type', 'application/octet-stream'),
+                self.max_file_bytes)
+            self.files.setdefault(name, []).append(self._part)
+        else:
+            self._part = []
+            self.fields.setdefault(name, []).append(self._part)
+
+    def _part_data(self, data):
+        if isinstance(self._part, SpooledFile):
+            self._part.write(data)
+        else:
+            self._part.append(data)
+            if sum(len(x) for x in self._part) > MAX_FIELD_BYTES:
+                raise UploadError('form field is too long')
+
+    def get_field(self, name, default=None):
+        try:
+            return ''.join(self.fields[name][0])
+        except KeyError:
+            return default
+
+    def discard(self):
+        """Remove all of the spooled files that haven't been committed."""
+        for spooled_files in self.files.itervalues():
+            for f in spooled_files:
+                f.discard()
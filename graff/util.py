@@ -1,8 +1,13 @@
+import collections
 import socket
 import struct
+import threading
+import time
 from tornado.escape import xhtml_escape
 import simplejson as json
 
+from graff import metrics
+
 class Flash(object):
 
     def __init__(self, info=None, error=None):
@@ -37,6 +42,88 @@ class Flash(object):
         del self.info[:]
         del self.error[:]
 
+class LRUCache(object):
+    """A thread-safe mapping that holds at most max_size items, evicting the
+    least recently used item when it's full.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return default
+            self._items[key] = value
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            if len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._items.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+class TTLCache(object):
+    """A thread-safe mapping whose items expire ttl seconds after they're
+    set. It holds at most max_size items. Hits and misses are counted in
+    metrics.CACHE_LOOKUPS, labeled with the cache's name.
+    """
+
+    def __init__(self, ttl, name, max_size=1024):
+        self.ttl = ttl
+        self.name = name
+        self.max_size = max_size
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and item[0] <= time.time():
+                del self._items[key]
+                item = None
+        metrics.CACHE_LOOKUPS.inc(cache=self.name, result='hit' if item is not None else 'miss')
+        return item[1] if item is not None else default
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            now = time.time()
+            if key not in self._items and len(self._items) >= self.max_size:
+                for k, (expires, _) in self._items.items():
+                    if expires <= now:
+                        del self._items[k]
+                if len(self._items) >= self.max_size:
+                    self._items.popitem()
+            self._items[key] = (now + self.ttl, value)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._items.pop(key, None)
+            return item[1] if item is not None else default
+
+    def clear(self):
+        """Invalidate everything in the cache."""
+        with self._lock:
+            self._items.clear()
 
 def inet_aton(ip_address):
     return struct.unpack('>L', socket.inet_aton(ip_address))[0]
@@ -15,7 +15,9 @@ CREATE TABLE photo (
   sensor BOOLEAN,
   time_created TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
   user_id INTEGER,
+  KEY (body_hash),
   KEY (time_created),
   KEY (geohash, time_created),
+  KEY user_time_created (user_id, time_created),
   PRIMARY KEY (id)
 ) Engine=InnoDB;
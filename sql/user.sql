@@ -1,7 +1,7 @@
 CREATE TABLE user (
   id INTEGER NOT NULL AUTO_INCREMENT,
   `name` VARCHAR(64) NOT NULL,
-  pw_hash CHAR(56) NOT NULL,
+  pw_hash VARCHAR(255) NOT NULL,
   email VARCHAR(128),
   location VARCHAR(128),
   signup_ip INTEGER UNSIGNED NOT NULL,
@@ -5,6 +5,10 @@
 GS.mapMode = 0;
 GS.map = null;
 
+// at this zoom level and below, the map shows clusters of photos rather than
+// individual photos
+GS.clusterZoom = 6;
+
 GS.unionStationCoords = {
     "lat": 34.056177,
     "lng": -118.236778
@@ -149,8 +153,53 @@ GS.getNearbyPosition = function (callback) {
     }
 };
 
+// remove all of the cluster markers from a map
+GS.clearClusters = function (map) {
+    while (map._clusterMarkers && map._clusterMarkers.length) {
+        map._clusterMarkers.pop().setMap(null);
+    }
+};
+
+// remove all of the photo markers from a map, along with their list entries
+GS.clearPhotoMarkers = function (map) {
+    while (map._markers.length) {
+        var m = map._markers.pop();
+        m.setMap(null);
+        $('#li_' + m._photo_id).remove();
+    }
+    map._oldBounds = null;
+};
+
+GS.updateClusters = function (map, params) {
+    params['cluster'] = 1;
+    $.get('/photos', params, function(data) {
+        GS.clearPhotoMarkers(map);
+        GS.clearClusters(map);
+        map._clusterMarkers = [];
+        for (var i = 0; i < data.clusters.length; i++) {
+            var c = data.clusters[i];
+            var m = new google.maps.Marker({
+                position: new google.maps.LatLng(c.latitude, c.longitude),
+                map: map,
+                title: c.count + (c.count === 1 ? ' photo' : ' photos')
+            });
+            // zoom in on a cluster when it's clicked
+            google.maps.event.addListener(m, "click", (function (position) {
+                return function () {
+                    map.setCenter(position);
+                    map.setZoom(map.getZoom() + 2);
+                };
+            })(m.getPosition()));
+            map._clusterMarkers.push(m);
+        }
+        if (debug === true) {
+            $("#time_elapsed").html("clustering completed in <strong>" + parseInt(data.time_ms) + "</strong> ms");
+        }
+    });
+};
+
 GS.updatePoints = function (map, params) {
-    params = params || {};
+    params = $.extend({}, params || {});
 
     // get the bounds so we can do a server-side search
     var bounds = map.getBounds();
@@ -161,6 +210,12 @@ GS.updatePoints = function (map, params) {
     params['e'] = ne.lng();
     params['w'] = sw.lng();
 
+    if (map.getZoom() <= GS.clusterZoom) {
+        GS.updateClusters(map, params);
+        return;
+    }
+    GS.clearClusters(map);
+
     var t1 = (new Date()).valueOf();
     $.get('/photos', params, function(data) {
         if (debug === true) {
@@ -0,0 +1,67 @@
+import random
+import unittest
+
+from graff import crypto
+
+# Tokens made for EncidTest.key by the original encid() and encrypt_string(),
+# which used PyCrypto's DES3 in CBC mode and base64.encodestring(). These check
+# the hand rolled CBC mode and base64 codec against them.
+KNOWN_TOKENS = (
+    (0, 'pJABQbPW3X5hcmSiH-MTzA'),
+    (1, 'HFi6Vp2Hru5DyKhwTPulYA'),
+    (12345, 'iawNGGekv1mn7JHeX8LnNw'),
+    (2 ** 31, '_HejXf4M7Ep99ayD3h5Z9A'),
+    (2 ** 32 - 1, 'DDDBvi6Ae7YOcPJcfuzHjA'),
+    )
+KNOWN_STRING = ('1349894400.123456.98765', 'RA0SPRVUQng3MVkAw-wgAqmUBe7w0ajSlqrBCyCp_0turlV1UtkpxQ')
+
+class EncidTest(unittest.TestCase):
+
+    def setUp(self):
+        # the tokens are memoized, so each test starts with empty caches to
+        # make sure that the batch functions do their own encryption
+        crypto._encid_cache.clear()
+        crypto._decid_cache.clear()
+        self.key = 'graff test key!!'
+        rng = random.Random(0)
+        self.ids = [0, 1, 2 ** 31, 2 ** 32 - 1] + [rng.randint(0, 2 ** 32 - 1) for _ in xrange(200)]
+
+    def test_encid_many(self):
+        tokens = crypto.encid_many(self.ids, self.key)
+        crypto._encid_cache.clear()
+        self.assertEqual(tokens, [crypto.encid(i, self.key) for i in self.ids])
+
+    def test_decid_many(self):
+        tokens = [crypto.encid(i, self.key) for i in self.ids]
+        self.assertEqual(crypto.decid_many(tokens, self.key), self.ids)
+        crypto._decid_cache.clear()
+        self.assertEqual([crypto.decid(token, self.key) for token in tokens], self.ids)
+
+    def test_decid_many_invalid(self):
+        token = crypto.encid(12345, self.key)
+        for bad in (token[:-1], ('A' if token[0] != 'A' else 'B') + token[1:], '!' * 22, None):
+            self.assertRaises(crypto.InvalidEncryptedId, crypto.decid_many, [token, bad], self.key)
+
+    def test_known_tokens(self):
+        for i, token in KNOWN_TOKENS:
+            self.assertEqual(crypto.encid(i, self.key), token)
+            self.assertEqual(crypto.decid(token, self.key), i)
+        crypto._encid_cache.clear()
+        crypto._decid_cache.clear()
+        self.assertEqual(crypto.encid_many([i for i, _ in KNOWN_TOKENS], self.key),
+                         [token for _, token in KNOWN_TOKENS])
+        self.assertEqual(crypto.decid_many([token for _, token in KNOWN_TOKENS], self.key),
+                         [i for i, _ in KNOWN_TOKENS])
+
+    def test_known_string(self):
+        plaintext, token = KNOWN_STRING
+        self.assertEqual(crypto.encrypt_string(plaintext, key=self.key), token)
+        self.assertEqual(crypto.decrypt_string(token, self.key), plaintext)
+
+    def test_token_length(self):
+        for token in crypto.encid_many(self.ids, self.key):
+            self.assertEqual(len(token), 22)
+            self.assertEqual(crypto.b64encode_token(crypto.b64decode_token(token)), token)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import datetime
+import unittest
+
+from graff import config
+config.load_config(None, memory=True)
+
+from graff import db
+
+class QueryCountTest(unittest.TestCase):
+    """Pins the number of queries that listing photos takes, so that loading
+    each photo's uploader separately can't creep back in.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        session = db.Session()
+        users = [db.User.create(session, name='query-count-%d' % (i,), pw_hash='-', email=None,
+                                location=None, remote_ip=0) for i in xrange(3)]
+        session.flush()
+        cls.user_name = users[0].name
+        now = datetime.datetime.now()
+        for i in xrange(30):
+            db.Photo.create(session,
+                            body_hash='%040x' % (i,),
+                            content_type='image/jpeg',
+                            fsid='%032x' % (i,),
+                            photo_height=600,
+                            photo_width=800,
+                            remote_ip=0,
+                            time_created=now - datetime.timedelta(seconds=i),
+                            user_id=users[i % len(users)].id)
+        session.commit()
+        session.close()
+
+    def setUp(self):
+        self.session = db.Session()
+
+    def tearDown(self):
+        self.session.close()
+
+    def test_most_recent(self):
+        with db.assert_max_queries(1):
+            summaries = [p.summary for p in db.Photo.most_recent(self.session, 20)]
+        self.assertEqual(len(summaries), 20)
+        self.assertTrue(all(s.user_name is not None for s in summaries))
+
+    def test_nearby_page(self):
+        with db.assert_max_queries(1):
+            summaries, next_cursor = db.Photo.nearby_page(self.session, 20)
+        self.assertEqual(len(summaries), 20)
+        self.assertTrue(all(s.user_name is not None for s in summaries))
+
+        with db.assert_max_queries(1):
+            more, _ = db.Photo.nearby_page(self.session, 20, before=db.decode_cursor(next_cursor))
+        self.assertEqual(len(more), 10)
+
+    def test_nearby_page_by_user(self):
+        # one query to look up the user, and one for their photos
+        with db.assert_max_queries(2):
+            summaries, _ = db.Photo.nearby_page(self.session, 20, user=self.user_name)
+        self.assertEqual(len(summaries), 10)
+        self.assertTrue(all(s.user_name == self.user_name for s in summaries))
+
+if __name__ == '__main__':
+    unittest.main()